@@ -0,0 +1,11 @@
+from pathlib import Path
+
+# Working directories, relative to where the backend is started
+UPLOAD_DIR = Path("uploads")
+PARSED_DIR = Path("parsed")
+DATA_DIR = Path("data")
+
+def ensure_dirs():
+    """Create the working directories if they don't exist yet"""
+    for directory in (UPLOAD_DIR, PARSED_DIR, DATA_DIR):
+        directory.mkdir(parents=True, exist_ok=True)
@@ -1,28 +1,33 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import os
-import json
+import orjson
 import asyncio
 from datetime import datetime
 import aiofiles
 from pathlib import Path
 from dotenv import load_dotenv
 import uuid
-import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Import our custom modules
+from config.paths import ensure_dirs
 from services.pdf_parser import PDFParserService
 from services.knowledge_base import KnowledgeBaseService
 from services.chat_service import ChatService
 from services.agent_service import AgentService
 from services.conversation_service import ConversationService
 from services.auth_service import AuthService
+from services.job_tracker import JobTracker
+from services.ingest import IngestService
+from services.agent_cache import AgentCache
 from models.schemas import (
     ChatRequest, ChatResponse, UploadResponse,
     AgentCreate, Agent, AgentStats, AgentUploadRequest, AgentChatRequest,
@@ -33,7 +38,8 @@ from routes.auth import router as auth_router, get_current_user
 app = FastAPI(
     title="MechAgent RAG Backend",
     description="FastAPI backend for RAG chatbot with LlamaParse integration",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -47,96 +53,175 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Create the upload, parsed and data directories before any service reads or writes them
+ensure_dirs()
+
 # Initialize services
 pdf_parser = PDFParserService()
 knowledge_base = KnowledgeBaseService()
-agent_service = AgentService()
 conversation_service = ConversationService()
+agent_service = AgentService(conversation_service)
 auth_service = AuthService()
 
 # Include authentication routes
 app.include_router(auth_router)
 
 # Job tracking for background processing
-processing_jobs = {}
-job_lock = threading.Lock()
-chat_service = ChatService(knowledge_base, agent_service)
+MAX_JOBS = int(os.getenv("MAX_JOBS", "1024"))
+JOB_TTL_SECONDS = 24 * 60 * 60
+JOB_SWEEP_INTERVAL_SECONDS = 5 * 60
+processing_jobs = JobTracker(max_jobs=MAX_JOBS, ttl_seconds=JOB_TTL_SECONDS)
+job_lock = asyncio.Lock()
+chat_service = ChatService(knowledge_base, agent_service, conversation_service)
+
+# Most endpoints look the agent up first; cache those lookups briefly
+agent_cache = AgentCache(agent_service.get_agent, ttl_seconds=5.0)
+
+# Shared upload pipeline (streaming save, parse cache, parsing)
+ingest_service = IngestService(
+    pdf_parser,
+    parse_concurrency=int(os.getenv("PARSE_CONCURRENCY", "6")),
+    cpu_workers=int(os.getenv("CPU_POOL_WORKERS", "4"))
+)
+
+# Per-job events used to push status changes to streaming clients, one per waiting client
+job_events = {}
+
+def notify_job_update(job_id: str):
+    """Wake any clients streaming this job's status"""
+    for event in job_events.pop(job_id, ()):
+        event.set()
+
+def new_upload_job(total_files: int) -> dict:
+    """Initial status of an upload job, registered before its job_id is returned"""
+    return {
+        "status": "processing",  # the frontend keeps polling while a job is "processing"
+        "progress": 0,
+        "total_files": total_files,
+        "processed_files": [],
+        "skipped_files": [],
+        "failed_files": [],
+        "total_chunks": 0,
+        "message": "Waiting to start file processing...",
+        "created_at": datetime.now().isoformat()
+    }
 
 # Background processing function
 async def process_files_background(job_id: str, agent_name: str, files_data: List[dict], user_id: str = None):
     """Process files in the background"""
     try:
-        with job_lock:
-            processing_jobs[job_id] = {
+        async with job_lock:
+            job = processing_jobs.get(job_id) or new_upload_job(len(files_data))
+            job.update({
                 "status": "processing",
-                "progress": 0,
-                "total_files": len(files_data),
-                "processed_files": [],
-                "skipped_files": [],
-                "failed_files": [],
-                "total_chunks": 0,
                 "message": "Starting file processing...",
                 "started_at": datetime.now().isoformat()
-            }
+            })
+            processing_jobs[job_id] = job
+        notify_job_update(job_id)
         
-        for i, file_data in enumerate(files_data):
+        parsed_files = []
+        
+        # Load the agent's indexed filenames once instead of querying per file
+        processed_filenames = await agent_service.get_processed_files(agent_name, user_id)
+        
+        async def process_one(file_data: dict):
             filename = file_data["filename"]
-            file_path = file_data["file_path"]
+            
+            # Claim the name before the first await, so a second copy in the same upload is skipped
+            # instead of being parsed and indexed again
+            already_processed = filename in processed_filenames
+            processed_filenames.add(filename)
             
             # Update progress
-            with job_lock:
-                processing_jobs[job_id]["progress"] = i
+            async with job_lock:
                 processing_jobs[job_id]["message"] = f"Processing {filename}..."
+            notify_job_update(job_id)
             
             try:
                 # Check if file is already processed
-                if await agent_service.is_file_already_processed(agent_name, filename):
-                    with job_lock:
+                if already_processed:
+                    async with job_lock:
                         processing_jobs[job_id]["skipped_files"].append({
                             "filename": filename,
                             "reason": "Already processed"
                         })
-                    continue
+                    notify_job_update(job_id)
+                    return
                 
-                # Parse with LlamaParse
-                chunks = await pdf_parser.parse_pdf(file_path, filename)
+                # Parse with LlamaParse (or reuse an earlier parse of identical content)
+                chunks = await ingest_service.parse(file_data, agent_name)
                 
                 if not chunks:
-                    with job_lock:
+                    async with job_lock:
                         processing_jobs[job_id]["failed_files"].append({
                             "filename": filename,
                             "reason": "No content extracted from PDF"
                         })
-                    continue
-                
-                # Save parsed chunks
-                parsed_file = f"parsed/{agent_name}_{Path(file_path).stem}_parsed.json"
-                async with aiofiles.open(parsed_file, 'w') as f:
-                    await f.write(json.dumps(chunks, indent=2))
-                
-                # Index chunks in agent's knowledge base
-                added_chunks = await agent_service.add_chunks_to_agent(agent_name, chunks, filename, user_id)
-                
-                with job_lock:
-                    processing_jobs[job_id]["processed_files"].append({
-                        "filename": filename,
-                        "file_size": file_data["file_size"]
-                    })
-                    processing_jobs[job_id]["total_chunks"] += len(chunks)
+                    notify_job_update(job_id)
+                    return
                 
+                # Defer indexing so all files share batched embedding requests
+                parsed_files.append((file_data, chunks))
                 print(f"Successfully processed {filename}: {len(chunks)} chunks created")
-                print(f"Added {added_chunks} chunks to agent '{agent_name}'")
                 
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
-                with job_lock:
+                async with job_lock:
                     processing_jobs[job_id]["failed_files"].append({
                         "filename": filename,
                         "reason": f"Processing failed: {str(e)}"
                     })
+                notify_job_update(job_id)
+            finally:
+                # Progress counts finished files since they complete out of order
+                async with job_lock:
+                    processing_jobs[job_id]["progress"] += 1
+                notify_job_update(job_id)
+        
+        # Parse files concurrently; the ingest service bounds LlamaParse API concurrency
+        await asyncio.gather(*[process_one(file_data) for file_data in files_data], return_exceptions=True)
+        
+        # Index chunks from all parsed files in agent's knowledge base
+        if parsed_files:
+            async with job_lock:
+                processing_jobs[job_id]["message"] = f"Indexing {len(parsed_files)} file(s)..."
+            notify_job_update(job_id)
+            
+            try:
+                added_chunks = await agent_service.add_chunks_batch(
+                    agent_name,
+                    [(file_data["filename"], chunks) for file_data, chunks in parsed_files],
+                    user_id
+                )
+                await agent_cache.invalidate(agent_name)
+                
+                async with job_lock:
+                    for file_data, chunks in parsed_files:
+                        processing_jobs[job_id]["processed_files"].append({
+                            "filename": file_data["filename"],
+                            "file_size": file_data["file_size"]
+                        })
+                        processing_jobs[job_id]["total_chunks"] += len(chunks)
+                notify_job_update(job_id)
+                
+                print(f"Added {added_chunks} chunks to agent '{agent_name}'")
+                
+            except Exception as e:
+                print(f"Error indexing files for {agent_name}: {e}")
+                async with job_lock:
+                    for file_data, _ in parsed_files:
+                        processing_jobs[job_id]["failed_files"].append({
+                            "filename": file_data["filename"],
+                            "reason": f"Indexing failed: {str(e)}"
+                        })
+                notify_job_update(job_id)
+        
+        # Get final agent stats before taking the lock (network call)
+        agent_stats = await agent_service.get_agent_stats(agent_name)
         
         # Mark as completed
-        with job_lock:
+        async with job_lock:
             job = processing_jobs[job_id]
             job["status"] = "completed"
             job["progress"] = len(files_data)
@@ -160,21 +245,53 @@ async def process_files_background(job_id: str, agent_name: str, files_data: Lis
                     failure_details.append(f"- {failed['filename']}: {failed['reason']}")
                 job["message"] += f"\n\nFailed files:\n" + "\n".join(failure_details)
             
-            # Get final agent stats
-            agent_stats = await agent_service.get_agent_stats(agent_name)
             job["final_total_chunks"] = agent_stats.get("total_chunks", 0)
+        notify_job_update(job_id)
     
     except Exception as e:
         print(f"Background processing error: {e}")
-        with job_lock:
+        async with job_lock:
             processing_jobs[job_id]["status"] = "failed"
             processing_jobs[job_id]["message"] = f"Processing failed: {str(e)}"
             processing_jobs[job_id]["completed_at"] = datetime.now().isoformat()
+        notify_job_update(job_id)
+
+async def sweep_processing_jobs():
+    """Periodically drop finished jobs older than the TTL"""
+    while True:
+        await asyncio.sleep(JOB_SWEEP_INTERVAL_SECONDS)
+        try:
+            async with job_lock:
+                removed = processing_jobs.prune_expired()
+            if removed:
+                print(f"Pruned {removed} expired upload job(s)")
+        except Exception as e:
+            print(f"Error pruning upload jobs: {e}")
+
+@app.on_event("shutdown")
+async def close_ingest_service():
+    ingest_service.close()
+
+@app.on_event("shutdown")
+async def close_chat_service():
+    await chat_service.close()
+
+@app.on_event("startup")
+async def configure_default_executor():
+    # asyncio.to_thread (Pinecone, Supabase and embedding calls) uses the loop's default
+    # executor, which is only min(32, cpu_count + 4) threads; size it per uvicorn worker
+    workers = int(os.getenv("THREAD_POOL_SIZE", "64"))
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix="io")
+    )
+
+@app.on_event("startup")
+async def start_job_sweeper():
+    app.state.job_sweeper = asyncio.create_task(sweep_processing_jobs())
 
-# Create necessary directories
-Path("uploads").mkdir(exist_ok=True)
-Path("parsed").mkdir(exist_ok=True)
-Path("data").mkdir(exist_ok=True)
+@app.on_event("shutdown")
+async def stop_job_sweeper():
+    app.state.job_sweeper.cancel()
 
 @app.get("/")
 async def root():
@@ -212,6 +329,7 @@ async def create_agent(agent_data: AgentCreate, current_user: dict = Depends(get
             agent_data.extra_instructions,
             user_id=current_user['id']
         )
+        await agent_cache.invalidate(agent_data.name)
         
         if not result.get('success'):
             raise HTTPException(status_code=400, detail=result.get('message', 'Failed to create agent'))
@@ -244,10 +362,10 @@ async def create_agent(agent_data: AgentCreate, current_user: dict = Depends(get
         print(f"Error creating agent: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/agents", response_model=List[Agent])
+@app.get("/api/agents")
 async def get_agents(current_user: dict = Depends(get_current_user)):
     """
-    Get list of all agents
+    Get list of all agents (already mapped to the Agent schema by the service, so not re-validated)
     """
     try:
         agents = await agent_service.get_agents(user_id=current_user['id'])
@@ -262,7 +380,7 @@ async def get_agent(agent_name: str, current_user: dict = Depends(get_current_us
     Get specific agent by name
     """
     try:
-        agent = await agent_service.get_agent(agent_name, user_id=current_user['id'])
+        agent = await agent_cache.get(agent_name, user_id=current_user['id'])
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         return agent
@@ -279,6 +397,7 @@ async def delete_agent(agent_name: str, current_user: dict = Depends(get_current
     """
     try:
         success = await agent_service.delete_agent(agent_name, user_id=current_user['id'])
+        await agent_cache.invalidate(agent_name)
         if not success:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         return {"message": f"Agent '{agent_name}' deleted successfully"}
@@ -311,7 +430,7 @@ async def upload_files_to_agent(agent_name: str, background_tasks: BackgroundTas
     """
     try:
         # Check if agent exists
-        agent = await agent_service.get_agent(agent_name, user_id=current_user['id'])
+        agent = await agent_cache.get(agent_name, user_id=current_user['id'])
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         
@@ -326,20 +445,15 @@ async def upload_files_to_agent(agent_name: str, background_tasks: BackgroundTas
                 continue  # Skip non-PDF files
             
             # Save uploaded file
-            file_path = f"uploads/{agent_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-            async with aiofiles.open(file_path, 'wb') as f:
-                content = await file.read()
-                await f.write(content)
-            
-            files_data.append({
-                "filename": file.filename,
-                "file_path": file_path,
-                "file_size": len(content)
-            })
+            files_data.append(await ingest_service.save_upload(file, agent_name))
         
         if not files_data:
             raise HTTPException(status_code=400, detail="No valid PDF files found")
         
+        # Register the job before returning its ID, so clients can stream or poll it right away
+        async with job_lock:
+            processing_jobs[job_id] = new_upload_job(len(files_data))
+        
         # Start background processing
         background_tasks.add_task(process_files_background, job_id, agent_name, files_data, current_user['id'])
         
@@ -363,7 +477,7 @@ async def upload_text_to_agent(agent_name: str, request: dict, current_user: dic
     """
     try:
         # Check if agent exists
-        agent = await agent_service.get_agent(agent_name, user_id=current_user['id'])
+        agent = await agent_cache.get(agent_name, user_id=current_user['id'])
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         
@@ -381,6 +495,7 @@ async def upload_text_to_agent(agent_name: str, request: dict, current_user: dic
         
         # Add chunks to agent's knowledge base
         added_chunks = await agent_service.add_chunks_to_agent(agent_name, chunks, f"{title}.txt", current_user['id'])
+        await agent_cache.invalidate(agent_name)
         
         return {
             "success": True,
@@ -402,7 +517,7 @@ async def crawl_links_for_agent(agent_name: str, request: dict, current_user: di
     """
     try:
         # Check if agent exists
-        agent = await agent_service.get_agent(agent_name, user_id=current_user['id'])
+        agent = await agent_cache.get(agent_name, user_id=current_user['id'])
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         
@@ -434,6 +549,7 @@ async def crawl_links_for_agent(agent_name: str, request: dict, current_user: di
         
         # Add chunks to agent's knowledge base
         added_chunks = await agent_service.add_chunks_to_agent(agent_name, all_chunks, processed_files, current_user['id'])
+        await agent_cache.invalidate(agent_name)
         
         response_message = f"Successfully crawled and processed {len(processed_files)} URL(s). Added {len(all_chunks)} chunks to {agent_name}'s knowledge base."
         if failed_urls:
@@ -461,6 +577,7 @@ async def reindex_agent_knowledge_base(agent_name: str, current_user: dict = Dep
     """
     try:
         result = await agent_service.reindex_agent_knowledge_base(agent_name, current_user['id'])
+        await agent_cache.invalidate(agent_name)
         
         if not result["success"]:
             raise HTTPException(status_code=500, detail=result["error"])
@@ -474,17 +591,74 @@ async def reindex_agent_knowledge_base(agent_name: str, current_user: dict = Dep
         raise HTTPException(status_code=500, detail=f"Reindexing failed: {str(e)}")
 
 @app.get("/api/agents/{agent_name}/upload/status/{job_id}")
-async def get_upload_status(agent_name: str, job_id: str, current_user: dict = Depends(get_current_user)):
+async def get_upload_status(agent_name: str, job_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     """
     Get the status of a background upload job
     """
-    with job_lock:
+    async with job_lock:
         if job_id not in processing_jobs:
             raise HTTPException(status_code=404, detail="Job not found")
         
         job = processing_jobs[job_id].copy()
     
-    return job
+    # Clients poll this endpoint; answer 304 while the job hasn't changed
+    etag = (
+        f'W/"{job["progress"]}-{job["status"]}-{job["total_chunks"]}-'
+        f'{len(job["failed_files"])}-{len(job["skipped_files"])}-{zlib.crc32(job["message"].encode()):x}"'
+    )
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    return ORJSONResponse(job, headers={"ETag": etag})
+
+@app.get("/api/agents/{agent_name}/upload/stream/{job_id}")
+async def stream_upload_status(agent_name: str, job_id: str, current_user: dict = Depends(get_current_user)):
+    """
+    Stream status updates of a background upload job as Server-Sent Events
+    """
+    async with job_lock:
+        if job_id not in processing_jobs:
+            raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def event_stream():
+        event = None
+        try:
+            while True:
+                # Register before reading so an update between the two isn't missed
+                event = asyncio.Event()
+                job_events.setdefault(job_id, set()).add(event)
+                
+                async with job_lock:
+                    job = processing_jobs.get(job_id)
+                    job = job.copy() if job else None
+                
+                if job is None:
+                    yield "event: error\ndata: {\"detail\": \"Job not found\"}\n\n"
+                    return
+                
+                yield f"data: {orjson.dumps(job).decode()}\n\n"
+                if job["status"] in ("completed", "failed"):
+                    return
+                
+                # Send a comment periodically so proxies keep the connection open
+                while not event.is_set():
+                    try:
+                        await asyncio.wait_for(event.wait(), timeout=15)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+        finally:
+            # Finished jobs and disconnected clients never get notified again, so unregister here
+            waiting = job_events.get(job_id)
+            if waiting is not None:
+                waiting.discard(event)
+                if not waiting:
+                    job_events.pop(job_id, None)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/api/agents/{agent_name}/chat", response_model=ChatResponse)
 async def chat_with_agent(agent_name: str, request: AgentChatRequest, current_user: dict = Depends(get_current_user)):
@@ -493,7 +667,7 @@ async def chat_with_agent(agent_name: str, request: AgentChatRequest, current_us
     """
     try:
         # Check if agent exists
-        agent = await agent_service.get_agent(agent_name, user_id=current_user['id'])
+        agent = await agent_cache.get(agent_name, user_id=current_user['id'])
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         
@@ -528,6 +702,62 @@ async def chat_with_agent(agent_name: str, request: AgentChatRequest, current_us
         print(f"Chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Bot replies still being saved after their stream ended (kept referenced until done)
+pending_saves = set()
+
+def stream_chat_events(message: str, conversation_id: str, agent_name: str, user_id: str, agent_id: Optional[str] = None):
+    """Relay ChatService.stream_response as Server-Sent Events and save the full reply when done"""
+    async def event_stream():
+        yield f"data: {orjson.dumps({'type': 'conversation', 'conversation_id': conversation_id}).decode()}\n\n"
+        
+        parts = []
+        error = None
+        try:
+            async for event in chat_service.stream_response(
+                message=message,
+                conversation_id=conversation_id,
+                agent_id=agent_id,
+                user_id=user_id
+            ):
+                if event["type"] == "token":
+                    parts.append(event["content"])
+                elif event["type"] == "error":
+                    error = event["content"]
+                yield f"data: {orjson.dumps(event).decode()}\n\n"
+        finally:
+            # Add bot response to conversation, also when the client disconnected mid-stream; after a
+            # failure keep the partial answer, and only store the error message when nothing was streamed.
+            # The save is shielded so it completes even if this generator is being cancelled
+            reply = "".join(parts) if parts else error
+            if reply:
+                save = asyncio.ensure_future(conversation_service.add_message(conversation_id, reply, "bot", agent_name, user_id))
+                pending_saves.add(save)
+                save.add_done_callback(pending_saves.discard)
+                await asyncio.shield(save)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/agents/{agent_name}/chat/stream")
+async def stream_chat_with_agent(agent_name: str, request: AgentChatRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Chat with a specific agent, streaming the response tokens as Server-Sent Events
+    """
+    agent = await agent_cache.get(agent_name, user_id=current_user['id'])
+    if not agent:
+        raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
+    
+    # Handle conversation creation/continuation
+    conversation_id = request.conversation_id
+    if not conversation_id:
+        conversation_id = await conversation_service.create_conversation(agent_name, request.message, current_user['id'])
+    
+    await conversation_service.add_message(conversation_id, request.message, "user", agent_name, current_user['id'])
+    return stream_chat_events(request.message, conversation_id, agent_name, current_user['id'], agent_id=agent_name)
+
 @app.post("/api/upload", response_model=UploadResponse)
 async def upload_files(files: List[UploadFile] = File(...)):
     """
@@ -540,38 +770,32 @@ async def upload_files(files: List[UploadFile] = File(...)):
         processed_files = []
         total_chunks = 0
         
-        for file in files:
-            if not file.filename.endswith('.pdf'):
+        # Save and parse PDFs concurrently through the shared ingest pipeline
+        pdf_files = [file for file in files if file.filename.endswith('.pdf')]
+        results = await asyncio.gather(*[ingest_service.ingest_pdf(file) for file in pdf_files], return_exceptions=True)
+        
+        for file, result in zip(pdf_files, results):
+            if isinstance(result, Exception):
+                print(f"Error parsing {file.filename}: {result}")
                 continue
-                
-            # Save uploaded file
-            file_path = f"uploads/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-            async with aiofiles.open(file_path, 'wb') as f:
-                content = await file.read()
-                await f.write(content)
             
-            # Parse with LlamaParse
+            file_data, chunks = result
             try:
-                chunks = await pdf_parser.parse_pdf(file_path, file.filename)
-                
-                # Save parsed chunks
-                parsed_file = f"parsed/{Path(file_path).stem}_parsed.json"
-                async with aiofiles.open(parsed_file, 'w') as f:
-                    await f.write(json.dumps(chunks, indent=2))
-                
                 # Index chunks in knowledge base
                 await knowledge_base.add_chunks(chunks)
                 
                 processed_files.append({
+                    "filename": file.filename,
+                    "file_size": file_data["file_size"],
                     "original_name": file.filename,
-                    "file_path": file_path,
-                    "parsed_file": parsed_file
+                    "file_path": file_data["file_path"],
+                    "parsed_file": file_data.get("parsed_file")
                 })
                 
                 total_chunks += len(chunks)
                 
-            except Exception as parse_error:
-                print(f"Error parsing {file.filename}: {parse_error}")
+            except Exception as index_error:
+                print(f"Error indexing {file.filename}: {index_error}")
                 continue
         
         if not processed_files:
@@ -624,6 +848,22 @@ async def chat(request: ChatRequest, current_user: dict = Depends(get_current_us
         print(f"Chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/chat/stream")
+async def stream_chat(request: ChatRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Process chat messages, streaming the response tokens as Server-Sent Events
+    """
+    if not request.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    
+    # Handle conversation creation/continuation
+    conversation_id = request.conversation_id
+    if not conversation_id:
+        conversation_id = await conversation_service.create_conversation("General", request.message, current_user['id'])
+    
+    await conversation_service.add_message(conversation_id, request.message, "user", "General", current_user['id'])
+    return stream_chat_events(request.message, conversation_id, "General", current_user['id'])
+
 @app.post("/api/crawl")
 async def crawl_website(urls: List[str] = Form(...), max_depth: int = Form(2)):
     """
@@ -675,7 +915,7 @@ async def get_agent_conversations(agent_name: str, current_user: dict = Depends(
     """
     try:
         # Check if agent exists
-        agent = await agent_service.get_agent(agent_name, user_id=current_user['id'])
+        agent = await agent_cache.get(agent_name, user_id=current_user['id'])
         if not agent:
             raise HTTPException(status_code=404, detail=f"Agent '{agent_name}' not found")
         
@@ -725,5 +965,14 @@ async def delete_conversation(conversation_id: str, current_user: dict = Depends
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # uvloop is not available on Windows
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )
@@ -0,0 +1,37 @@
+-- Row-level counter updates for agents
+-- Adding chunks used to read the whole agent row, modify total_chunks/files in Python
+-- and write it back, which loses updates when uploads to the same agent overlap.
+-- This function applies the change in a single UPDATE instead.
+
+CREATE OR REPLACE FUNCTION add_agent_chunks(
+    p_agent_id UUID,
+    p_chunk_delta INTEGER,
+    p_filenames JSONB DEFAULT '[]'::jsonb
+)
+RETURNS agents AS $$
+DECLARE
+    updated agents;
+BEGIN
+    UPDATE agents
+    SET total_chunks = GREATEST(0, COALESCE(total_chunks, 0) + p_chunk_delta),
+        files = merged.files,
+        total_files = jsonb_array_length(merged.files)
+    FROM (
+        -- Append new filenames, keeping existing order and skipping duplicates
+        SELECT COALESCE(a.files, '[]'::jsonb) || COALESCE(
+            (SELECT jsonb_agg(DISTINCT f)
+             FROM jsonb_array_elements(p_filenames) AS f
+             WHERE NOT COALESCE(a.files, '[]'::jsonb) @> jsonb_build_array(f)),
+            '[]'::jsonb
+        ) AS files
+        FROM agents a
+        WHERE a.id = p_agent_id
+    ) AS merged
+    WHERE agents.id = p_agent_id
+    RETURNING agents.* INTO updated;
+
+    RETURN updated;
+END;
+$$ language 'plpgsql';
+
+GRANT EXECUTE ON FUNCTION add_agent_chunks(UUID, INTEGER, JSONB) TO authenticated;
@@ -0,0 +1,38 @@
+-- Single round trip message inserts and indexes for the conversation queries
+-- Adding a message used to check the conversation exists, insert the message and then
+-- bump the conversation's updated_at: three requests per message.
+-- add_conversation_message does all of it in one transaction and also keeps message_count current.
+
+CREATE INDEX IF NOT EXISTS idx_conversations_user_agent_updated ON conversations(user_id, agent_name, updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations(user_id, updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp ON messages(conversation_id, timestamp);
+
+CREATE OR REPLACE FUNCTION add_conversation_message(
+    p_message_id UUID,
+    p_conversation_id UUID,
+    p_text TEXT,
+    p_sender VARCHAR,
+    p_agent_name VARCHAR
+)
+RETURNS messages AS $$
+DECLARE
+    inserted messages;
+BEGIN
+    UPDATE conversations
+    SET updated_at = NOW(),
+        message_count = COALESCE(message_count, 0) + 1
+    WHERE id = p_conversation_id;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Conversation % not found', p_conversation_id USING ERRCODE = 'P0002';
+    END IF;
+
+    INSERT INTO messages (id, conversation_id, text, sender, agent_name, timestamp)
+    VALUES (p_message_id, p_conversation_id, p_text, p_sender, p_agent_name, NOW())
+    RETURNING * INTO inserted;
+
+    RETURN inserted;
+END;
+$$ language 'plpgsql';
+
+GRANT EXECUTE ON FUNCTION add_conversation_message(UUID, UUID, TEXT, VARCHAR, VARCHAR) TO authenticated;
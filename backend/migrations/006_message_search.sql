@@ -0,0 +1,35 @@
+-- Full-text search over message bodies
+-- A GIN index on the message text's tsvector lets search_messages answer from the index
+-- instead of scanning every message, ranking hits with ts_rank.
+-- Searches are always scoped to one user: a NULL p_user_id matches nothing.
+
+CREATE INDEX IF NOT EXISTS idx_messages_text_fts ON messages USING GIN (to_tsvector('english', text));
+
+CREATE OR REPLACE FUNCTION search_messages(
+    p_agent_name VARCHAR,
+    p_query TEXT,
+    p_user_id UUID DEFAULT NULL,
+    p_limit INTEGER DEFAULT 20
+)
+RETURNS TABLE (
+    id UUID,
+    conversation_id UUID,
+    text TEXT,
+    sender VARCHAR,
+    "timestamp" TIMESTAMP WITH TIME ZONE,
+    agent_name VARCHAR,
+    rank REAL
+) AS $$
+    SELECT m.id, m.conversation_id, m.text, m.sender, m.timestamp, m.agent_name,
+           ts_rank(to_tsvector('english', m.text), q) AS rank
+    FROM messages m
+    JOIN conversations c ON c.id = m.conversation_id,
+         websearch_to_tsquery('english', p_query) AS q
+    WHERE m.agent_name = p_agent_name
+      AND c.user_id = p_user_id
+      AND to_tsvector('english', m.text) @@ q
+    ORDER BY rank DESC, m.timestamp DESC
+    LIMIT p_limit;
+$$ language 'sql' STABLE;
+
+GRANT EXECUTE ON FUNCTION search_messages(VARCHAR, TEXT, UUID, INTEGER) TO authenticated;
@@ -22,12 +22,18 @@ def main():
     # Configuration from environment variables
     host = os.getenv('FASTAPI_HOST', '0.0.0.0')
     port = int(os.getenv('FASTAPI_PORT', 8000))
-    reload = os.getenv('FASTAPI_RELOAD', 'true').lower() == 'true'
+    reload = os.getenv('FASTAPI_RELOAD', 'false').lower() == 'true'
+    # Upload job status lives in process memory, so keep one worker unless jobs are pinned
+    workers = int(os.getenv('WEB_CONCURRENCY', 1))
+    # uvloop is not available on Windows
+    loop = 'asyncio' if sys.platform == 'win32' else 'uvloop'
     
     print(f"Starting MechAgent FastAPI backend...")
     print(f"Host: {host}")
     print(f"Port: {port}")
     print(f"Reload: {reload}")
+    print(f"Workers: {workers}")
+    print(f"Event loop: {loop}")
     print(f"API Documentation: http://{host}:{port}/docs")
     
     # Create necessary directories
@@ -41,6 +47,9 @@ def main():
         host=host,
         port=port,
         reload=reload,
+        workers=None if reload else workers,
+        loop=loop,
+        http="httptools",
         log_level="info"
     )
 
@@ -0,0 +1,37 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+class AgentCache:
+    """Short-TTL in-process cache in front of AgentService.get_agent"""
+    
+    def __init__(self, loader: Callable[..., Awaitable[Optional[Dict[str, Any]]]], ttl_seconds: float = 5.0):
+        self.loader = loader
+        self.ttl = ttl_seconds
+        self._entries: Dict[Tuple[str, Optional[str]], Tuple[Dict[str, Any], float]] = {}
+        self._lock = asyncio.Lock()
+    
+    async def get(self, agent_name: str, user_id: str = None) -> Optional[Dict[str, Any]]:
+        """Return the agent, loading it if the cached copy is missing or expired"""
+        key = (agent_name, user_id)
+        now = time.monotonic()
+        
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                return entry[0]
+        
+        # Load outside the lock so a slow lookup doesn't block other agents
+        agent = await self.loader(agent_name, user_id=user_id)
+        
+        # Missing agents are not cached so a newly created one is visible immediately
+        if agent:
+            async with self._lock:
+                self._entries[key] = (agent, time.monotonic() + self.ttl)
+        return agent
+    
+    async def invalidate(self, agent_name: str):
+        """Drop cached entries for an agent across all users"""
+        async with self._lock:
+            for key in [key for key in self._entries if key[0] == agent_name]:
+                del self._entries[key]
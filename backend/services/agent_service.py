@@ -1,6 +1,6 @@
 import os
 import asyncio
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set, Tuple
 from datetime import datetime
 from pathlib import Path
 from pinecone import Pinecone, ServerlessSpec
@@ -8,12 +8,30 @@ from openai import OpenAI
 import uuid
 import time
 from config.supabase_client import get_supabase_client
+from services.embedding_batcher import EmbeddingBatcher
+from services.upsert_batcher import UpsertBatcher
+from services.semantic_cache import SemanticQueryCache, SEMANTIC_CACHE_TTL_SECONDS
+from services.vector_delete import delete_ids_by_filter
+
+# Metadata value types Pinecone accepts as-is (exact types, checked with a set lookup)
+_SCALAR_TYPES = frozenset((str, int, float, bool))
+
+def _clean_value(value: Any) -> Any:
+    """Convert a non-scalar metadata value (or a scalar subclass) to something Pinecone accepts"""
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
 
 class AgentService:
-    def __init__(self):
+    def __init__(self, conversation_service=None):
         # Initialize Supabase client
         self.supabase = get_supabase_client()
         
+        # Shared with the API so deleting an agent's conversations also clears its message cache
+        self.conversation_service = conversation_service
+        
         # Initialize Pinecone
         self.pinecone_api_key = os.getenv('PINECONE_API_KEY')
         if not self.pinecone_api_key:
@@ -32,21 +50,52 @@ class AgentService:
         self.dimension = 1536  # OpenAI text-embedding-ada-002 dimension
         self.embedding_model = "text-embedding-ada-002"
         
+        # Index handle, created on first use and shared by all agents (one namespace each)
+        self._index = None
+        
+        # Search results keyed by query embedding, per namespace; paraphrases hit too
+        self.query_cache = SemanticQueryCache(
+            threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95')),
+            max_entries=1024,
+            ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS
+        )
+        
+        # Concurrent embedding calls (searches, ingests) share OpenAI requests
+        self.embedding_batcher = EmbeddingBatcher(self._embed_texts, max_batch_size=100, max_latency_ms=8)
+        
+        # Small concurrent ingests share Pinecone upsert requests
+        self.upsert_batcher = UpsertBatcher(self._upsert_vectors, max_batch_size=100, max_latency_ms=50)
+        
         print("Agent service initialized with Pinecone")
     
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch of texts with one OpenAI request (blocking; called by the batcher)"""
+        response = self.openai_client.embeddings.create(
+            input=texts,
+            model=self.embedding_model
+        )
+        return [item.embedding for item in response.data]
+    
+    def _upsert_vectors(self, vectors: List[Dict[str, Any]], namespace: str):
+        """Upsert one batch of vectors (blocking; called by the upsert batcher)"""
+        self._get_index().upsert(vectors=vectors, namespace=namespace)
+    
     async def _generate_embedding(self, text: str) -> List[float]:
         """Generate embedding using OpenAI API"""
         try:
-            response = await asyncio.to_thread(
-                self.openai_client.embeddings.create,
-                input=text,
-                model=self.embedding_model
-            )
-            return response.data[0].embedding
+            return await self.embedding_batcher.encode(text)
         except Exception as e:
             print(f"Error generating embedding: {e}")
             raise
     
+    async def _generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for many texts, batched into shared OpenAI requests"""
+        try:
+            return await self.embedding_batcher.encode_many(texts)
+        except Exception as e:
+            print(f"Error generating embeddings: {e}")
+            raise
+    
     def _get_agent_namespace(self, agent_name: str, user_id: str = None) -> str:
         """Generate a unique namespace for an agent"""
         if user_id:
@@ -76,6 +125,12 @@ class AgentService:
             print(f"Error setting up Pinecone index: {e}")
             return False
     
+    def _get_index(self):
+        """Return the shared Pinecone index handle, creating it once"""
+        if self._index is None:
+            self._index = self.pc.Index(self.base_index_name)
+        return self._index
+    
     def _get_agents_for_user(self, user_id: str = None) -> List[Dict[str, Any]]:
         """Get all agents for a specific user"""
         try:
@@ -216,17 +271,20 @@ class AgentService:
             # Delete from Pinecone namespace
             if namespace:
                 try:
-                    index = self.pc.Index(self.base_index_name)
+                    index = self._get_index()
                     # Delete all vectors in the namespace
-                    index.delete(delete_all=True, namespace=namespace)
+                    await asyncio.to_thread(index.delete, delete_all=True, namespace=namespace)
                     print(f"Deleted Pinecone namespace: {namespace}")
+                    self.query_cache.invalidate(namespace)
                 except Exception as e:
                     print(f"Error deleting Pinecone namespace: {e}")
             
             # Delete all conversations for this agent
             try:
-                from services.conversation_service import ConversationService
-                conversation_service = ConversationService()
+                conversation_service = self.conversation_service
+                if conversation_service is None:
+                    from services.conversation_service import ConversationService
+                    conversation_service = ConversationService()
                 deleted_conversations = await conversation_service.delete_agent_conversations(name, user_id)
                 print(f"Deleted {deleted_conversations} conversations for agent '{name}'")
             except Exception as e:
@@ -248,25 +306,102 @@ class AgentService:
             print(f"Error deleting agent: {e}")
             return False
     
-    async def is_file_already_processed(self, agent_name: str, filename: str) -> bool:
-        """Check if a file has already been processed by an agent"""
+    async def get_processed_files(self, agent_name: str, user_id: str = None) -> Set[str]:
+        """Get the set of filenames an agent has already indexed, for O(1) membership checks"""
         try:
-            agents = self._load_agents()
-            
-            if agent_name not in agents:
-                return False
-            
-            agent = agents[agent_name]
-            return filename in agent.get("files", [])
+            agent = await self.get_agent(agent_name, user_id)
+            if not agent:
+                return set()
+            return set(agent.get("files") or [])
             
         except Exception as e:
-            print(f"Error checking if file is processed: {e}")
-            return False
+            print(f"Error loading processed files: {e}")
+            return set()
+    
+    async def is_file_already_processed(self, agent_name: str, filename: str, user_id: str = None) -> bool:
+        """Check if a file has already been processed by an agent"""
+        return filename in await self.get_processed_files(agent_name, user_id)
     
     async def add_chunks_to_agent(self, agent_name: str, chunks: List[Dict[str, Any]], filenames = None, user_id: str = None) -> int:
         """Add text chunks to a specific agent's knowledge base"""
+        # Handle filenames parameter - can be string, list, or None
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        elif filenames is None:
+            filenames = []
+        
+        # Chunks without a filename of their own take the first one; the rest are only recorded on the agent
+        file_chunks = [(filenames[0] if filenames else None, chunks)]
+        file_chunks.extend((filename, []) for filename in filenames[1:])
+        return await self.add_chunks_batch(agent_name, file_chunks, user_id)
+    
+    async def _embed_and_upsert(self, namespace: str, texts: List[str], vectors: List[Dict[str, Any]], batch_size: int = 100):
+        """Embed and upsert vectors in batches, upserting batch N while batch N+1 is being embedded"""
+        # Two embedded batches may wait for upsert, which bounds memory if Pinecone is slower
+        ready: asyncio.Queue = asyncio.Queue(maxsize=2)
+        
+        async def produce():
+            try:
+                for i in range(0, len(vectors), batch_size):
+                    batch = vectors[i:i + batch_size]
+                    embeddings = await self._generate_embeddings(texts[i:i + batch_size])
+                    for vector, embedding in zip(batch, embeddings):
+                        vector['values'] = embedding
+                    await ready.put(batch)
+            finally:
+                await ready.put(None)
+        
+        async def consume():
+            while True:
+                batch = await ready.get()
+                if batch is None:
+                    return
+                await self.upsert_batcher.upsert(namespace, batch)
+        
+        producer = asyncio.create_task(produce())
+        try:
+            await consume()
+            await producer
+        finally:
+            producer.cancel()
+            self.query_cache.invalidate(namespace)
+    
+    def _record_added_chunks(self, agent: Dict[str, Any], chunk_delta: int, filenames: List[str]):
+        """Increment an agent's chunk count and append new filenames in a single row update"""
+        try:
+            # add_agent_chunks (migrations/004) does the increment in the database, so
+            # concurrent uploads to the same agent can't overwrite each other's counts
+            self.supabase.rpc('add_agent_chunks', {
+                'p_agent_id': agent['id'],
+                'p_chunk_delta': chunk_delta,
+                'p_filenames': filenames
+            }).execute()
+            return
+        except Exception as e:
+            # Only fall back when the function isn't installed; any other error may come after
+            # the RPC committed, and repeating the update would apply the delta twice
+            if getattr(e, "code", None) not in ("PGRST202", "42883"):
+                raise
+            print(f"add_agent_chunks RPC unavailable, falling back to full update: {e}")
+        
+        current_files = list(agent.get('files') or [])
+        known_files = set(current_files)
+        for filename in filenames:
+            if filename not in known_files:
+                known_files.add(filename)
+                current_files.append(filename)
+        
+        update_data = {
+            'total_chunks': agent.get('total_chunks', 0) + chunk_delta,
+            'files': current_files,
+            'total_files': len(current_files),
+            'updated_at': datetime.now().isoformat()
+        }
+        self.supabase.table('agents').update(update_data).eq('id', agent['id']).execute()
+    
+    async def add_chunks_batch(self, agent_name: str, file_chunks: List[Tuple[str, List[Dict[str, Any]]]], user_id: str = None) -> int:
+        """Add chunks from several files to an agent with batched embedding and upsert requests"""
         try:
-            # Get agent data from Supabase
             agent = await self.get_agent(agent_name, user_id)
             if not agent:
                 raise ValueError(f"Agent '{agent_name}' not found")
@@ -275,89 +410,47 @@ class AgentService:
             if not namespace:
                 raise ValueError(f"Agent '{agent_name}' has no collection_name configured")
             
-            if not chunks:
-                return 0
-            
-            # Handle filenames parameter - can be string, list, or None
-            if isinstance(filenames, str):
-                filenames = [filenames]
-            elif filenames is None:
-                filenames = []
-            
-            # Get Pinecone index
-            index = self.pc.Index(self.base_index_name)
-            
-            # Prepare data for Pinecone
+            # Flatten all files into one list of texts and vector stubs
+            texts = []
             vectors_to_upsert = []
+            filenames = []
             
-            for chunk in chunks:
-                text = chunk.get('text', '').strip()
-                if not text:
-                    continue
-                
-                chunk_id = chunk.get('chunk_id') or str(uuid.uuid4())
-                metadata = chunk.get('metadata', {})
-                
-                # Add agent to metadata
-                metadata['agent_name'] = agent_name
-                metadata['user_id'] = user_id
-                
-                # Add filename to metadata if available
-                if 'filename' in metadata:
-                    # Use filename from chunk metadata if available
-                    pass
-                elif filenames:
-                    # Use the first filename if available
-                    metadata['filename'] = filenames[0]
-                
-                # Add text to metadata since Pinecone doesn't store documents separately
-                metadata['text'] = text
-                
-                # Ensure metadata is JSON serializable
-                clean_metadata = self._clean_metadata(metadata)
-                
-                # Generate embedding using OpenAI
-                embedding = await self._generate_embedding(text)
+            for filename, chunks in file_chunks:
+                if filename:
+                    filenames.append(filename)
                 
-                # Add to vectors list
-                vectors_to_upsert.append({
-                    'id': chunk_id,
-                    'values': embedding,
-                    'metadata': clean_metadata
-                })
+                for chunk in chunks or []:
+                    text = chunk.get('text', '').strip()
+                    if not text:
+                        continue
+                    
+                    metadata = chunk.get('metadata', {})
+                    metadata['agent_name'] = agent_name
+                    metadata['user_id'] = user_id
+                    if 'filename' not in metadata and filename:
+                        metadata['filename'] = filename
+                    metadata['text'] = text
+                    
+                    texts.append(text)
+                    vectors_to_upsert.append({
+                        'id': chunk.get('chunk_id') or uuid.uuid4().hex,
+                        'metadata': self._clean_metadata(metadata)
+                    })
             
             if not vectors_to_upsert:
                 return 0
             
-            # Upsert vectors to Pinecone
-            index.upsert(vectors=vectors_to_upsert, namespace=namespace)
-            
-            # Update agent metadata in Supabase
-            supabase = get_supabase_client()
-            current_chunks = agent.get('total_chunks', 0)
-            current_files = agent.get('files', [])
+            # One embedding request per batch instead of per chunk
+            await self._embed_and_upsert(namespace, texts, vectors_to_upsert)
             
-            # Add new filenames to agent's files list
-            if filenames:
-                for filename in filenames:
-                    if filename and filename not in current_files:
-                        current_files.append(filename)
-            
-            # Update agent in Supabase
-            update_data = {
-                'total_chunks': current_chunks + len(vectors_to_upsert),
-                'files': current_files,
-                'total_files': len(current_files),
-                'updated_at': datetime.now().isoformat()
-            }
-            
-            supabase.table('agents').update(update_data).eq('name', agent_name).execute()
+            # Update agent metadata in Supabase once for all files
+            self._record_added_chunks(agent, len(vectors_to_upsert), filenames)
             
-            print(f"Added {len(vectors_to_upsert)} chunks to agent '{agent_name}'")
+            print(f"Added {len(vectors_to_upsert)} chunks from {len(file_chunks)} file(s) to agent '{agent_name}'")
             return len(vectors_to_upsert)
             
         except Exception as e:
-            print(f"Error adding chunks to agent: {e}")
+            print(f"Error adding chunk batch to agent: {e}")
             raise
     
     async def search_agent(self, agent_name: str, query: str, top_k: int = 5, user_id: str = None) -> List[Dict[str, Any]]:
@@ -373,13 +466,20 @@ class AgentService:
                 raise ValueError(f"Agent '{agent_name}' has no collection_name configured")
             
             # Get Pinecone index
-            index = self.pc.Index(self.base_index_name)
+            index = self._get_index()
             
             # Generate query embedding using OpenAI
             query_embedding = await self._generate_embedding(query)
             
+            # Reuse results of a near-identical earlier query
+            cached_results = self.query_cache.lookup(namespace, top_k, query_embedding)
+            if cached_results is not None:
+                print(f"Semantic cache hit for query: {query[:50]}...")
+                return cached_results
+            
             # Search Pinecone
-            results = index.query(
+            results = await asyncio.to_thread(
+                index.query,
                 vector=query_embedding,
                 top_k=top_k,
                 namespace=namespace,
@@ -397,6 +497,7 @@ class AgentService:
                         "rank": i + 1
                     })
             
+            self.query_cache.add(namespace, top_k, query_embedding, search_results)
             return search_results
             
         except Exception as e:
@@ -416,20 +517,20 @@ class AgentService:
                 raise ValueError(f"Agent '{agent_name}' has no collection_name configured")
             
             # Get Pinecone index
-            index = self.pc.Index(self.base_index_name)
+            index = self._get_index()
             
             # Get current count from Pinecone
-            stats = index.describe_index_stats()
+            stats = await asyncio.to_thread(index.describe_index_stats)
             namespace_stats = stats.get('namespaces', {}).get(namespace, {})
             count = namespace_stats.get('vector_count', 0)
             
-            # Update agent metadata with current count in Supabase
-            supabase = get_supabase_client()
-            update_data = {
-                'total_chunks': count,
-                'updated_at': datetime.now().isoformat()
-            }
-            supabase.table('agents').update(update_data).eq('name', agent_name).execute()
+            # Sync the stored count only when it drifted, so reading stats is normally write-free
+            if count != agent.get('total_chunks'):
+                update_data = {
+                    'total_chunks': count,
+                    'updated_at': datetime.now().isoformat()
+                }
+                self.supabase.table('agents').update(update_data).eq('id', agent['id']).execute()
             
             return {
                 "agent_name": agent_name,
@@ -447,18 +548,12 @@ class AgentService:
             return {"error": str(e)}
     
     def _clean_metadata(self, metadata: Dict[str, Any]) -> Dict[str, Any]:
-        """Clean metadata to ensure it's JSON serializable for ChromaDB"""
-        clean_metadata = {}
+        """Clean metadata to ensure it's JSON serializable for Pinecone"""
+        # Fast path: parser metadata is usually all plain scalars already
+        if all(type(value) in _SCALAR_TYPES for value in metadata.values()):
+            return dict(metadata)
         
-        for key, value in metadata.items():
-            if isinstance(value, (str, int, float, bool)):
-                clean_metadata[key] = value
-            elif isinstance(value, datetime):
-                clean_metadata[key] = value.isoformat()
-            else:
-                clean_metadata[key] = str(value)
-        
-        return clean_metadata
+        return {key: value if type(value) in _SCALAR_TYPES else _clean_value(value) for key, value in metadata.items()}
     
     async def delete_file_from_agent(self, agent_name: str, filename: str, user_id: str = None) -> int:
         """Delete all chunks associated with a specific filename from an agent"""
@@ -473,42 +568,21 @@ class AgentService:
                 raise ValueError(f"Agent '{agent_name}' has no collection_name configured")
             
             # Get Pinecone index
-            index = self.pc.Index(self.base_index_name)
-            
-            # Query for vectors with the specified filename
-            query_results = index.query(
-                vector=[0] * 384,  # Dummy vector for metadata filtering
-                top_k=10000,  # Large number to get all matches
-                namespace=namespace,
-                filter={"filename": filename},
-                include_metadata=True
-            )
+            index = self._get_index()
             
-            deleted_count = 0
-            if query_results.get('matches'):
-                # Extract IDs to delete
-                ids_to_delete = [match['id'] for match in query_results['matches']]
-                
-                # Delete vectors from Pinecone
-                index.delete(ids=ids_to_delete, namespace=namespace)
-                deleted_count = len(ids_to_delete)
+            deleted_count = await delete_ids_by_filter(index, namespace, {"filename": filename}, self.dimension)
+            if deleted_count:
+                self.query_cache.invalidate(namespace)
                 
                 # Update agent metadata in Supabase
-                supabase = get_supabase_client()
-                current_files = agent.get('files', [])
-                current_chunks = agent.get('total_chunks', 0)
-                
-                if filename in current_files:
-                    current_files.remove(filename)
-                
+                current_files = [f for f in agent.get('files') or [] if f != filename]
                 update_data = {
                     'files': current_files,
                     'total_files': len(current_files),
-                    'total_chunks': max(0, current_chunks - deleted_count),
+                    'total_chunks': max(0, agent.get('total_chunks', 0) - deleted_count),
                     'updated_at': datetime.now().isoformat()
                 }
-                
-                supabase.table('agents').update(update_data).eq('name', agent_name).execute()
+                self.supabase.table('agents').update(update_data).eq('id', agent['id']).execute()
             
             return deleted_count
             
@@ -529,11 +603,12 @@ class AgentService:
                 raise ValueError(f"Agent '{agent_name}' has no collection_name configured")
             
             # Get Pinecone index
-            index = self.pc.Index(self.base_index_name)
+            index = self._get_index()
             
             # Delete all vectors in the agent's namespace
             try:
-                index.delete(delete_all=True, namespace=namespace)
+                await asyncio.to_thread(index.delete, delete_all=True, namespace=namespace)
+                self.query_cache.invalidate(namespace)
                 print(f"Cleared all vectors in namespace '{namespace}' for agent '{agent_name}'")
             except Exception as e:
                 print(f"Warning: Could not clear namespace {namespace}: {e}")
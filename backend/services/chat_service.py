@@ -1,29 +1,175 @@
 import os
 import re
-import json
-from typing import List, Dict, Any, Optional
+import sys
+from typing import AsyncIterator, Awaitable, List, Dict, Any, Optional
 from datetime import datetime
 import asyncio
+import hashlib
+import time
+import httpx
+import orjson
+from array import array
+from collections import OrderedDict
 from models.schemas import ChatResponse
 from services.knowledge_base import KnowledgeBaseService
 from services.agent_service import AgentService
+from services.conversation_service import ConversationService
+from services.semantic_cache import SEMANTIC_CACHE_TTL_SECONDS
 from langchain_openai import ChatOpenAI
 from langchain_community.utilities import GoogleSerperAPIWrapper
 from langchain.schema import HumanMessage, SystemMessage
 from config.supabase_client import get_supabase_client
 import uuid
 
+NO_CONTEXT_RESPONSE = "I'm sorry, I couldn't find any relevant information for your query. Please upload relevant technical documentation or try rephrasing your question."
+ERROR_RESPONSE = "I apologize, but I encountered an error while processing your request. Please try again."
+
+# Below this many characters of retrieved text (and with no web links), the LLM can only
+# produce the no-context answer, so the call is skipped
+MIN_CONTEXT_CHARS = int(os.getenv('MIN_CONTEXT_CHARS', '80'))
+
+# Fixed instructions sent as the system message of every chat LLM call
+RESPONSE_GUIDELINES = """You are a friendly technical support chatbot helping maintenance technicians. Provide helpful, conversational answers based on the information in the user's message.
+
+CHATBOT RESPONSE GUIDELINES:
+- Be conversational and helpful, like talking to a colleague
+- Keep initial answers concise (2-3 sentences) but offer to elaborate
+- Use bullet points for step-by-step instructions
+- Include part numbers and safety warnings when available
+- When relevant links are provided, include them naturally in your response
+- If info is incomplete, suggest specific next steps or resources
+- Use friendly language: "Here's what I found...", "You'll want to...", "Let me help with that..."
+- Reference previous conversation when relevant
+- Follow any agent-specific instructions provided
+
+EXAMPLE RESPONSES:
+Q: "How do I reset the system?"
+To reset the system, press and hold the reset button for 5 seconds - you'll find it on the main control panel (Part #RST-001).
+
+Q: "What's the operating temperature range?"
+The operating range is -10°C to 60°C. Need to know anything specific about temperature monitoring or troubleshooting?
+
+Q: "How do I replace the filter?"
+Here's how to replace the filter:\n\n• **First, turn off power** and unplug the unit for safety\n• Remove the front panel by pressing the two side tabs\n• Slide out the old filter (Part #FLT-200) and dispose of it\n• Insert the new filter until you hear it click into place\n• Reattach the panel and power back up\n\nNeed help finding the right replacement filter or have questions about the process?"""
+
+# LangChain messages are not modified once built, so the fixed system message is shared by every call
+_RESPONSE_GUIDELINES_MESSAGE = SystemMessage(content=RESPONSE_GUIDELINES)
+
+# Words that signal the user wants web/online information (matched as substrings)
+WEB_KEYWORDS = [
+    'search online', 'search web', 'find online', 'look up online',
+    'google', 'internet', 'website', 'url', 'link', 'online',
+    'current', 'latest', 'recent', 'new', 'updated', 'today',
+    'official website', 'manufacturer website', 'download',
+    'buy', 'purchase', 'price', 'cost', 'where to buy'
+]
+
+# Compiled once per process; matched against the lowercased message
+_WEB_KEYWORDS_RE = re.compile("|".join(map(re.escape, WEB_KEYWORDS)))
+
+# Product/model references that might need official sources
+_PRODUCT_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'\b[A-Z]{2,}\d+[A-Z]*\b',  # Product codes like UR10e, ABC123
+    r'\bmodel\s+\w+',  # "model XYZ"
+    r'\bpart\s+number',  # "part number"
+    r'\bserial\s+number',  # "serial number"
+)]
+
+# Common conversational words removed from web search queries
+_STOP_WORDS = frozenset({'how', 'do', 'i', 'can', 'you', 'help', 'me', 'with', 'what', 'is', 'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'as', 'by'})
+
+# Technical query patterns and the search context each one adds
+_TECHNICAL_PATTERNS = [(re.compile(pattern, re.IGNORECASE), context) for pattern, context in (
+    (r'\b([A-Z]{2,}\d+[A-Z]*)\b', 'model'),  # Product codes
+    (r'\berror\s+code\s+(\w+)', 'error code'),
+    (r'\bpart\s+number\s+(\w+)', 'part number'),
+    (r'\bmanual\s+for\s+(\w+)', 'manual'),
+    (r'\btroubleshoot\s+(\w+)', 'troubleshooting'),
+    (r'\binstall\s+(\w+)', 'installation guide'),
+    (r'\breplace\s+(\w+)', 'replacement guide'),
+)]
+
+# One organic web result as it appears in the LLM context
+_WEB_RESULT_TEMPLATE = "**{title}**\n{snippet}\nSource: {link}\n"
+
+class _WebResultFields(dict):
+    """Serper result fields for _WEB_RESULT_TEMPLATE; missing fields format as ''"""
+    def __missing__(self, key):
+        return ''
+
+def _truncate_snippet(snippet: str, limit: int = 200) -> str:
+    return snippet[:limit] + '...' if len(snippet) > limit else snippet
+
+# Keys of one knowledge base search result
+_RESULT_FIELDS = {"text", "metadata", "similarity_score", "rank"}
+
+class _PackedResults:
+    """
+    Knowledge base search results stored column-wise for the in-process query cache.
+    Rows with the same metadata keys share one key tuple and repeated strings (filenames,
+    sources, timestamps) are interned, so a cached entry is a few lists and tuples rather
+    than two dicts per chunk.
+    """
+    __slots__ = ('texts', 'scores', 'ranks', 'metadata_keys', 'metadata_values')
+    
+    def __init__(self, results: List[Dict[str, Any]]):
+        key_table: Dict[tuple, tuple] = {}
+        self.texts = [result['text'] for result in results]
+        self.scores = array('d', (result['similarity_score'] for result in results))
+        self.ranks = array('i', (result['rank'] for result in results))
+        self.metadata_keys = []
+        self.metadata_values = []
+        for result in results:
+            keys = tuple(result['metadata'])
+            self.metadata_keys.append(key_table.setdefault(keys, keys))
+            self.metadata_values.append(tuple(
+                sys.intern(value) if type(value) is str else value for value in result['metadata'].values()
+            ))
+    
+    @staticmethod
+    def packable(results: List[Dict[str, Any]]) -> bool:
+        return all(result.keys() == _RESULT_FIELDS and isinstance(result['metadata'], dict) for result in results)
+    
+    def unpack(self) -> List[Dict[str, Any]]:
+        return [{
+            "text": text,
+            "metadata": dict(zip(keys, values)),
+            "similarity_score": score,
+            "rank": rank
+        } for text, keys, values, score, rank in zip(self.texts, self.metadata_keys, self.metadata_values, self.scores, self.ranks)]
+
 class ChatService:
-    def __init__(self, knowledge_base: KnowledgeBaseService, agent_service: AgentService):
+    def __init__(self, knowledge_base: KnowledgeBaseService, agent_service: AgentService, conversation_service: Optional[ConversationService] = None):
         self.knowledge_base = knowledge_base
         self.agent_service = agent_service
+        self.conversation_service = conversation_service
         self.supabase = get_supabase_client()
         self.openrouter_api_key = os.getenv('OPENROUTER_API_KEY')
         self.serper_api_key = os.getenv('SERPER_API_KEY')
         
-        # Simple cache for recent queries (in production, use Redis)
-        self._query_cache = {}
+        # LRU cache for recent queries; used when Redis is not configured
+        self._query_cache = OrderedDict()
         self._cache_max_size = 100
+        self._cache_lock = asyncio.Lock()
+        
+        # Redis query cache shared by all workers (set REDIS_URL to enable)
+        self._cache_ttl = float(os.getenv('QUERY_CACHE_TTL_SECONDS', str(SEMANTIC_CACHE_TTL_SECONDS)))
+        self._redis = self._initialize_redis()
+        
+        # Cache keys include a generation per search scope (an agent's namespace, or "" for the shared
+        # knowledge base), bumped whenever the services invalidate their own caches after an upload,
+        # delete or reindex, so earlier results are never read again. "*" covers every agent.
+        self._cache_generations: Dict[str, int] = {}
+        self._generation_tasks = set()
+        knowledge_base.query_cache.add_listener(lambda namespace: self._invalidate_search_cache(""))
+        agent_service.query_cache.add_listener(lambda namespace: self._invalidate_search_cache(namespace if namespace is not None else "*"))
+        
+        # Pooled async HTTP client shared by the LLM and Serper calls, so requests reuse
+        # keep-alive connections instead of paying a TCP/TLS handshake each time
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+            timeout=httpx.Timeout(60.0, connect=10.0)
+        )
         
         # Initialize LLM
         self.llm = self._initialize_llm()
@@ -31,9 +177,6 @@ class ChatService:
         # Initialize web search tool
         self.web_search_tool = self._initialize_web_search()
         
-        # System prompt for technical assistance
-        self.system_prompt = self._get_system_prompt()
-        
         print(f"ChatService initialized with LLM: {bool(self.llm)}, Web Search: {bool(self.web_search_tool)}")
     
     def _initialize_llm(self) -> Optional[ChatOpenAI]:
@@ -50,7 +193,8 @@ class ChatService:
                 temperature=0.2,  # Slightly higher for more natural responses
                 openai_api_key=self.openrouter_api_key,
                 base_url="https://openrouter.ai/api/v1/",
-                max_tokens=500  # Reduced for shorter responses
+                max_tokens=500,  # Reduced for shorter responses
+                http_async_client=self._http_client
             )
         except ImportError as e:
             print(f"Import error initializing LLM (pydantic version conflict): {e}")
@@ -60,6 +204,19 @@ class ChatService:
             print(f"Error initializing LLM: {e}")
             return None
     
+    def _initialize_redis(self):
+        """Connect the shared query cache to Redis if REDIS_URL is set"""
+        redis_url = os.getenv('REDIS_URL')
+        if not redis_url:
+            return None
+        
+        try:
+            import redis.asyncio as redis_asyncio
+            return redis_asyncio.Redis.from_url(redis_url)
+        except Exception as e:
+            print(f"Error initializing Redis query cache, using in-process cache: {e}")
+            return None
+    
     def _initialize_web_search(self) -> Optional[GoogleSerperAPIWrapper]:
         """Initialize web search with proper error handling"""
         if not self.serper_api_key:
@@ -72,42 +229,20 @@ class ChatService:
             print(f"Warning: Could not initialize web search tool: {e}")
             return None
     
-    def _get_system_prompt(self) -> str:
-        """Get the system prompt for the technical assistant"""
-        return """You are a friendly and knowledgeable technical support chatbot helping maintenance technicians with equipment issues.
-
-Your personality:
-- Conversational and approachable, like a helpful colleague
-- Professional but not overly formal
-- Patient and understanding when users need clarification
-- Enthusiastic about helping solve technical problems
-
-Your expertise:
-- Equipment maintenance, troubleshooting, and operations
-- Safety procedures and best practices
-- Step-by-step technical guidance
-- Part identification and replacement procedures
-
-Your communication style:
-- Use friendly, conversational language
-- Start with direct answers, then offer additional help ONLY IF YOU THINK ITS NEEDED
-- Include relevant links when available to help users learn more
-- Ask follow-up questions to better assist users
-- Use emojis sparingly but appropriately (⚠️ for warnings, ✅ for confirmations)
-- Always prioritize safety in your recommendations
-
-Remember: You're here to make technical support feel less intimidating and more collaborative!"""
-        
-    async def _search_knowledge_base(self, query: str, agent_id: Optional[str] = None, top_k: int = 5, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    async def _search_knowledge_base(self, query: str, agent_id: Optional[str] = None, top_k: int = 5, user_id: Optional[str] = None, query_lower: Optional[str] = None) -> List[Dict[str, Any]]:
         """Search the knowledge base with caching for faster responses"""
         try:
-            # Create cache key
-            cache_key = f"{agent_id or 'global'}:{query.lower().strip()}:{top_k}"
+            # Create cache key (query_lower is the stripped, lowercased query when the caller already has it).
+            # Agent namespaces include the user, so users with same-named agents never share entries
+            scope = self.agent_service._get_agent_namespace(agent_id, user_id) if agent_id else ""
+            generation = await self._cache_generation(scope)
+            cache_key = f"{scope}:{generation}:{query_lower if query_lower is not None else query.lower().strip()}:{top_k}"
             
-            # Check cache first
-            if cache_key in self._query_cache:
+            # Check cache first, marking the entry as recently used
+            cached = await self._cache_get(cache_key)
+            if cached is not None:
                 print(f"Cache hit for query: {query[:50]}...")
-                return self._query_cache[cache_key]
+                return cached
             
             # Perform search
             if agent_id:
@@ -115,45 +250,91 @@ Remember: You're here to make technical support feel less intimidating and more
             else:
                 results = await self.knowledge_base.search(query, top_k=top_k)
             
-            # Cache results (limit cache size)
-            if len(self._query_cache) >= self._cache_max_size:
-                # Remove oldest entry (simple FIFO)
-                oldest_key = next(iter(self._query_cache))
-                del self._query_cache[oldest_key]
-            
-            self._query_cache[cache_key] = results
-            print(f"Knowledge base search: {len(results)} total results (cached)")
+            # Empty results aren't cached, so a document uploaded right after shows up on the next query
+            if results:
+                await self._cache_set(cache_key, results)
+            print(f"Knowledge base search: {len(results)} total results")
             return results
             
         except Exception as e:
             print(f"Error searching knowledge base: {e}")
             return []
     
-    def _generate_search_query(self, message: str) -> str:
+    async def _cache_generation(self, scope: str) -> str:
+        """Current cache generation of a search scope, combined with the all-agents generation"""
+        if self._redis:
+            try:
+                values = await self._redis.mget(f"kb_query_gen:{scope}", "kb_query_gen:*")
+                return ".".join(value.decode() if value else "0" for value in values)
+            except Exception as e:
+                print(f"Redis generation read failed, using in-process generation: {e}")
+        return f"{self._cache_generations.get(scope, 0)}.{self._cache_generations.get('*', 0)}"
+    
+    def _invalidate_search_cache(self, scope: str):
+        """Bump a scope's cache generation so results cached before the change are never read again"""
+        self._cache_generations[scope] = self._cache_generations.get(scope, 0) + 1
+        if self._redis:
+            try:
+                task = asyncio.get_running_loop().create_task(self._bump_redis_generation(scope))
+                self._generation_tasks.add(task)
+                task.add_done_callback(self._generation_tasks.discard)
+            except RuntimeError:
+                # No running loop (called outside a request); entries still expire on their TTL
+                pass
+    
+    async def _bump_redis_generation(self, scope: str):
+        try:
+            await self._redis.incr(f"kb_query_gen:{scope}")
+        except Exception as e:
+            print(f"Redis generation bump failed: {e}")
+    
+    async def _cache_get(self, cache_key: str) -> Optional[List[Dict[str, Any]]]:
+        """Look up cached search results in Redis, or the in-process LRU when Redis is off or failing"""
+        if self._redis:
+            try:
+                cached = await self._redis.get(f"kb_query:{cache_key}")
+                return orjson.loads(cached) if cached is not None else None
+            except Exception as e:
+                print(f"Redis cache read failed, using in-process cache: {e}")
+        
+        async with self._cache_lock:
+            entry = self._query_cache.get(cache_key)
+            if entry is not None:
+                cached_at, cached = entry
+                if time.monotonic() - cached_at >= self._cache_ttl:
+                    del self._query_cache[cache_key]
+                    return None
+                self._query_cache.move_to_end(cache_key)
+                return cached.unpack() if isinstance(cached, _PackedResults) else cached
+        return None
+    
+    async def _cache_set(self, cache_key: str, results: List[Dict[str, Any]]):
+        """Cache search results, evicting the least recently used in-process entry when full"""
+        if self._redis:
+            try:
+                await self._redis.setex(f"kb_query:{cache_key}", max(1, int(self._cache_ttl)), orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY))
+                return
+            except Exception as e:
+                print(f"Redis cache write failed, using in-process cache: {e}")
+        
+        packed = _PackedResults(results) if _PackedResults.packable(results) else results
+        async with self._cache_lock:
+            self._query_cache[cache_key] = (time.monotonic(), packed)
+            self._query_cache.move_to_end(cache_key)
+            while len(self._query_cache) > self._cache_max_size:
+                self._query_cache.popitem(last=False)
+    
+    def _generate_search_query(self, message: str, message_lower: Optional[str] = None) -> str:
         """Generate an optimized search query from the user message"""
-        # Remove common conversational words and focus on technical terms
-        stop_words = {'how', 'do', 'i', 'can', 'you', 'help', 'me', 'with', 'what', 'is', 'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'as', 'by'}
-        
-        # Extract key technical terms
-        words = message.lower().split()
-        filtered_words = [word.strip('.,?!') for word in words if word.strip('.,?!') not in stop_words and len(word) > 2]
-        
-        # Look for specific patterns that indicate technical queries
-        technical_patterns = {
-            r'\b([A-Z]{2,}\d+[A-Z]*)\b': 'model',  # Product codes
-            r'\berror\s+code\s+(\w+)': 'error code',
-            r'\bpart\s+number\s+(\w+)': 'part number',
-            r'\bmanual\s+for\s+(\w+)': 'manual',
-            r'\btroubleshoot\s+(\w+)': 'troubleshooting',
-            r'\binstall\s+(\w+)': 'installation guide',
-            r'\breplace\s+(\w+)': 'replacement guide'
-        }
+        # Extract key technical terms, dropping common conversational words
+        words = (message_lower if message_lower is not None else message.lower()).split()
+        filtered_words = [word.strip('.,?!') for word in words if word.strip('.,?!') not in _STOP_WORDS and len(word) > 2]
         
         enhanced_query = ' '.join(filtered_words)
         
-        # Add context based on patterns
-        for pattern, context in technical_patterns.items():
-            if re.search(pattern, message, re.IGNORECASE):
+        # Add context based on patterns that indicate technical queries
+        for pattern, context in _TECHNICAL_PATTERNS:
+            if pattern.search(message):
                 enhanced_query += f' {context}'
                 break
         
@@ -161,19 +342,32 @@ Remember: You're here to make technical support feel less intimidating and more
         
         return enhanced_query.strip() or message  # Fallback to original if filtering removes everything
 
-    async def _search_web(self, query: str) -> Dict[str, Any]:
+    async def _search_web(self, query: str, query_lower: Optional[str] = None, kb_results: Optional[Awaitable[List[Dict[str, Any]]]] = None) -> Dict[str, Any]:
         """Search the web for additional information and extract links with improved query"""
         if not self.web_search_tool:
             return {"text": "", "links": []}
         
         try:
             # Generate optimized search query
-            search_query = self._generate_search_query(query)
+            search_query = self._generate_search_query(query, query_lower)
             print(f"Original query: {query}")
             print(f"Optimized search query: {search_query}")
             
-            # Use results() method to get structured JSON data from Serper.dev
-            raw_results = await asyncio.to_thread(self.web_search_tool.results, search_query)
+            # Get structured JSON data from Serper.dev
+            searches = [asyncio.ensure_future(self._serper_results(search_query))]
+            
+            # Product codes get their own query, but only when the knowledge base search (kb_results,
+            # running concurrently) came back marginal; otherwise the second Serper call adds nothing
+            code_query = self._product_code_query(query)
+            if code_query and code_query.lower() != search_query.lower() and kb_results is not None:
+                if self._kb_text_length(await kb_results) < MIN_CONTEXT_CHARS:
+                    searches.append(self._serper_results(code_query))
+                    print(f"Product code search query: {code_query}")
+            
+            responses = await asyncio.gather(*searches, return_exceptions=True)
+            raw_results = self._merge_serper_results([r for r in responses if isinstance(r, dict)])
+            if raw_results is None:
+                raise responses[0]
             
             # Parse and extract structured data from search results
             parsed_results = self._parse_web_results(raw_results)
@@ -183,6 +377,58 @@ Remember: You're here to make technical support feel less intimidating and more
             print(f"Web search error: {e}")
             return {"text": "", "links": []}
     
+    @staticmethod
+    def _kb_text_length(chunks: List[Dict[str, Any]]) -> int:
+        """Amount of retrieved text in the top knowledge base chunks, without headers or source labels"""
+        return sum(len(chunk.get('text', '').strip()) for chunk in chunks[:3])
+    
+    def _product_code_query(self, message: str) -> str:
+        """Build a search query from the product codes in a message, or '' if there are none"""
+        codes = dict.fromkeys(match.group(0) for match in _PRODUCT_PATTERNS[0].finditer(message) if any(c.isdigit() for c in match.group(0)))
+        return ' '.join(codes)
+    
+    def _merge_serper_results(self, responses: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Merge Serper responses, deduplicating organic results by URL and ranking them by average position"""
+        if not responses:
+            return None
+        if len(responses) == 1:
+            return responses[0]
+        
+        positions: Dict[str, List[int]] = {}
+        results: Dict[str, Dict[str, Any]] = {}
+        for response in responses:
+            for position, result in enumerate(response.get('organic', [])):
+                link = result.get('link')
+                if link:
+                    positions.setdefault(link, []).append(position)
+                    results.setdefault(link, result)
+        
+        # A result missing from a response counts as ranked just after that response's last result
+        def average_position(link: str) -> float:
+            missing = len(responses) - len(positions[link])
+            penalty = sum(len(response.get('organic', [])) for response in responses) / len(responses)
+            return (sum(positions[link]) + missing * penalty) / len(responses)
+        
+        # The first (full message) response keeps its answer box and knowledge graph
+        merged = dict(responses[0])
+        merged['organic'] = [results[link] for link in sorted(results, key=average_position)[:5]]
+        return merged
+    
+    async def _serper_results(self, query: str) -> Dict[str, Any]:
+        """Query Serper.dev over the pooled client (same request GoogleSerperAPIWrapper.results makes)"""
+        tool = self.web_search_tool
+        params = {"q": query, "gl": tool.gl, "hl": tool.hl, "num": tool.k}
+        if tool.tbs:
+            params["tbs"] = tool.tbs
+        
+        response = await self._http_client.post(
+            f"https://google.serper.dev/{tool.type}",
+            headers={"X-API-KEY": self.serper_api_key, "Content-Type": "application/json"},
+            params=params
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    
     def _parse_web_results(self, raw_results: Dict[str, Any]) -> Dict[str, Any]:
         """Parse web search results to extract links and structured information"""
         links = []
@@ -192,25 +438,18 @@ Remember: You're here to make technical support feel less intimidating and more
             # raw_results is already a dictionary from GoogleSerperAPIWrapper
             data = raw_results
             
-            # Extract organic results
-            if 'organic' in data:
-                for i, result in enumerate(data['organic'][:5]):  # Top 5 results
-                    title = result.get('title', '')
-                    link = result.get('link', '')
-                    snippet = result.get('snippet', '')
-                    
-                    if link and title:
-                        links.append({
-                            'title': title,
-                            'url': link,
-                            'snippet': snippet[:200] + '...' if len(snippet) > 200 else snippet
-                        })
-                        
-                        text_content.append(f"**{title}**\n{snippet}\nSource: {link}\n")
+            # Extract organic results (top 5) that have both a title and a link
+            organic = [result for result in data.get('organic', ())[:5] if result.get('link') and result.get('title')]
+            links = [{
+                'title': result['title'],
+                'url': result['link'],
+                'snippet': _truncate_snippet(result.get('snippet', ''))
+            } for result in organic]
+            text_content = [_WEB_RESULT_TEMPLATE.format_map(_WebResultFields(result)) for result in organic]
             
             # Extract answer box if available
-            if 'answerBox' in data:
-                answer = data['answerBox']
+            answer = data.get('answerBox')
+            if answer:
                 if 'answer' in answer:
                     text_content.insert(0, f"**Quick Answer:** {answer['answer']}\n")
                 if 'link' in answer:
@@ -221,8 +460,8 @@ Remember: You're here to make technical support feel less intimidating and more
                     })
             
             # Extract knowledge graph if available
-            if 'knowledgeGraph' in data:
-                kg = data['knowledgeGraph']
+            kg = data.get('knowledgeGraph')
+            if kg:
                 if 'title' in kg and 'description' in kg:
                     text_content.insert(0, f"**{kg['title']}**\n{kg['description']}\n")
                     if 'website' in kg:
@@ -245,41 +484,28 @@ Remember: You're here to make technical support feel less intimidating and more
             "links": links
         }
     
-    def _should_include_web_links(self, message: str, kb_context: str, web_results: Dict[str, Any]) -> bool:
+    def _should_include_web_links(self, message: str, kb_context: str, web_results: Dict[str, Any], message_lower: Optional[str] = None) -> bool:
         """Determine if web links should be included in the response based on relevance"""
         if not web_results or not web_results.get('links'):
             return False
             
-        message_lower = message.lower()
+        if message_lower is None:
+            message_lower = message.lower()
+        kb_length = len(kb_context.strip()) if kb_context else 0
         
         # Always include links if user explicitly requests web/online information
-        web_keywords = [
-            'search online', 'search web', 'find online', 'look up online',
-            'google', 'internet', 'website', 'url', 'link', 'online',
-            'current', 'latest', 'recent', 'new', 'updated', 'today',
-            'official website', 'manufacturer website', 'download',
-            'buy', 'purchase', 'price', 'cost', 'where to buy'
-        ]
-        
-        if any(keyword in message_lower for keyword in web_keywords):
+        if _WEB_KEYWORDS_RE.search(message_lower):
             return True
         
         # Include links if knowledge base results are insufficient
-        if not kb_context or len(kb_context.strip()) < 100:
+        if kb_length < 100:
             return True
         
         # Include links for specific product/model queries that might need official sources
-        product_patterns = [
-            r'\b[A-Z]{2,}\d+[A-Z]*\b',  # Product codes like UR10e, ABC123
-            r'\bmodel\s+\w+',  # "model XYZ"
-            r'\bpart\s+number',  # "part number"
-            r'\bserial\s+number',  # "serial number"
-        ]
-        
-        for pattern in product_patterns:
-            if re.search(pattern, message, re.IGNORECASE):
+        for pattern in _PRODUCT_PATTERNS:
+            if pattern.search(message):
                 # Include links if we don't have comprehensive info
-                if len(kb_context.strip()) < 300:
+                if kb_length < 300:
                     return True
         
         # Check if web results contain highly relevant information
@@ -293,105 +519,167 @@ Remember: You're here to make technical support feel less intimidating and more
         # Include links if web results are highly relevant (>50% keyword match)
         return relevance_score > 0.5
     
+    def _dedupe_paragraphs(self, text: str, seen: set) -> str:
+        """Drop paragraphs already included elsewhere in the context (chunks overlap, web snippets repeat)"""
+        kept = []
+        for paragraph in text.split("\n\n"):
+            key = hashlib.blake2b(paragraph.strip().encode('utf-8'), digest_size=8).digest()
+            if paragraph.strip() and key in seen:
+                continue
+            seen.add(key)
+            kept.append(paragraph)
+        return "\n\n".join(kept)
+    
+    def _build_doc_context(self, chunks: List[Dict[str, Any]], seen: set) -> str:
+        """Build the knowledge base part of the context, recording its paragraphs in seen"""
+        if not chunks:
+            return ""
+        
+        # Joined once rather than grown with +=
+        doc_parts = ["Technical Documentation:\n"]
+        doc_parts.extend(
+            f"\n[Source {i}: {chunk.get('metadata', {}).get('filename', 'Unknown')}]\n{self._dedupe_paragraphs(chunk.get('text', '').strip(), seen)}\n"
+            for i, chunk in enumerate(chunks[:3], 1)  # Limit to top 3 chunks
+        )
+        return "".join(doc_parts)
+    
+    def _add_web_context(self, doc_context: str, web_results: Optional[Dict[str, Any]], seen: set) -> str:
+        """Append web results to an already built document context"""
+        if not web_results or not web_results.get('text'):
+            return doc_context
+        
+        web_context = f"Web Search Results:\n{self._dedupe_paragraphs(web_results['text'], seen)}"
+        return f"{doc_context}\n\n{web_context}" if doc_context else web_context
+    
     def _build_context(self, chunks: List[Dict[str, Any]], web_results: Dict[str, Any] = None) -> str:
         """Build context from knowledge base chunks and web results"""
-        context_parts = []
+        seen = set()
+        return self._add_web_context(self._build_doc_context(chunks, seen), web_results, seen)
+    
+    async def _retrieve(self, message: str, conversation_id: Optional[str], agent_id: Optional[str], user_id: Optional[str]) -> Dict[str, Any]:
+        """Gather conversation history, knowledge base chunks and web results for a message"""
+        # Steps 0-2 are independent network calls, so run them concurrently:
+        # conversation history, knowledge base search and (if available) web search
+        # Normalize the message once for cache keys, query building and keyword checks
+        message = message.strip()
+        message_lower = message.lower()
         
-        if chunks:
-            # Add document context
-            doc_context = "Technical Documentation:\n"
-            for i, chunk in enumerate(chunks[:3], 1):  # Limit to top 3 chunks
-                text = chunk.get('text', '').strip()
-                filename = chunk.get('metadata', {}).get('filename', 'Unknown')
-                doc_context += f"\n[Source {i}: {filename}]\n{text}\n"
-            context_parts.append(doc_context)
+        history_task = self.get_conversation_history(conversation_id) if conversation_id else asyncio.sleep(0, result=[])
+        kb_task = asyncio.ensure_future(self._search_knowledge_base(message, agent_id, user_id=user_id, query_lower=message_lower))
+        web_task = self._search_web(message, message_lower, kb_task) if self.web_search_tool else asyncio.sleep(0, result=None)
+        if self.web_search_tool:
+            print("Performing web search...")
+        history_data, chunks, web_results = await asyncio.gather(history_task, kb_task, web_task)
+        
+        # Step 0: Conversation history if conversation_id is provided
+        conversation_history = []
+        if conversation_id:
+            if history_data:
+                # Convert to format expected by prompt creation
+                conversation_history = []
+                for msg in history_data:
+                    if msg.get('sender') == 'user':
+                        conversation_history.append({'message': msg.get('text', ''), 'response': ''})
+                    elif msg.get('sender') == 'bot' and conversation_history:
+                        conversation_history[-1]['response'] = msg.get('text', '')
+            print(f"Retrieved {len(conversation_history)} conversation history entries")
+        
+        # Step 1: Knowledge base results; the doc context is built once and reused in step 3
+        seen_paragraphs = set()
+        kb_context = self._build_doc_context(chunks, seen_paragraphs)
+        
+        print(f"Knowledge base results: {len(kb_context)} characters")
+        
+        # Step 2: Web search always runs, but links are only included when relevant
+        web_links = []
+        
+        if web_results is not None:
+            print(f"Web search results: {len(web_results.get('text', ''))} characters, {len(web_results.get('links', []))} links")
+            
+            # Determine if web links should be included in response
+            should_include_links = self._should_include_web_links(message, kb_context, web_results, message_lower)
+            web_links = web_results.get('links', []) if should_include_links else []
+            
+            if should_include_links:
+                print(f"Including {len(web_links)} relevant web links in response")
+            else:
+                print("Web search performed but links not relevant enough to include")
+        else:
+            print("Web search tool not available")
+        
+        # Step 3: Combine results
+        context = self._add_web_context(kb_context, web_results, seen_paragraphs)
         
-        if web_results and web_results.get('text'):
-            context_parts.append(f"Web Search Results:\n{web_results['text']}")
+        # Amount of actual retrieved text, without the headers and source labels in context
+        info_length = self._kb_text_length(chunks)
+        if web_results:
+            info_length += len(web_results.get('text', '').strip())
         
-        return "\n\n".join(context_parts)
+        return {
+            "chunks": chunks,
+            "web_links": web_links,
+            "context": context,
+            "has_context": bool(context) and (info_length >= MIN_CONTEXT_CHARS or bool(web_links)),
+            "conversation_history": conversation_history
+        }
     
-    def _create_prompt(self, query: str, context: str, conversation_history: List[Dict[str, Any]] = None) -> List:
-        """Create a structured prompt for the LLM with conversation history"""
-        messages = [SystemMessage(content=self.system_prompt)]
+    async def _build_llm_prompt(self, message: str, context: str, web_links: List[Dict[str, Any]], conversation_history: List[Dict[str, Any]], agent_id: Optional[str]) -> List:
+        """Build the LLM messages from the retrieved context"""
+        # Get agent-specific instructions if agent_id is provided
+        agent_instructions = ""
+        if agent_id and self.agent_service:
+            agent = await self.agent_service.get_agent(agent_id)
+            if agent and agent.get('extra_instructions'):
+                agent_instructions = f"\n\nAGENT-SPECIFIC INSTRUCTIONS:\n{agent['extra_instructions']}"
+        
+        # Create optimized chatbot prompt - include links only if they are relevant
+        links_text = ""
+        
+        if web_links:
+            links_text = "\n\nRELEVANT LINKS (include these naturally in your response when helpful):\n" + "".join(
+                f"{i}. [{link['title']}]({link['url']})\n" for i, link in enumerate(web_links[:3], 1)
+            )
         
-        # Add conversation history if available
+        # Add conversation history context
+        history_context = ""
         if conversation_history:
-            for entry in conversation_history[-5:]:  # Last 5 exchanges
-                if entry.get('message') and entry.get('response'):
-                    messages.append(HumanMessage(content=entry['message']))
-                    messages.append(SystemMessage(content=entry['response']))
+            history_context = "\n\nCONVERSATION CONTEXT (recent exchanges):\n" + "".join(
+                f"Previous Q{i}: {entry['message'][:100]}...\nPrevious A{i}: {entry['response'][:100]}...\n\n"
+                for i, entry in enumerate(conversation_history[-3:], 1)  # Last 3 exchanges
+                if entry.get('message') and entry.get('response')
+            )
         
-        # Add current query with context
-        if context:
-            user_prompt = f"""Based on the following technical documentation and information, please answer the user's question:
-
-{context}
-
-User Question: {query}
+        # Only the per-request parts go in the user message; the fixed guidelines and examples
+        # are the system message, an identical prefix on every call that provider prompt caches can reuse
+        prompt = f"""Technical Documentation:
+{context}{links_text}{history_context}
 
-Provide a detailed, practical response based on the available information. If the context doesn't fully answer the question, mention what information is available and what might be missing."""
-        else:
-            user_prompt = f"""The user asked: {query}
+Extra instructions for your response:
+{agent_instructions}
 
-I don't have specific technical documentation available for this question. Please provide a helpful response and suggest uploading relevant technical manuals or documentation."""
-        
-        messages.append(HumanMessage(content=user_prompt))
-        return messages
+User Question: {message}"""
         
+        print(f"\n=== LLM Call ===")
+        print(f"Prompt Length: {len(prompt)} characters")
+        print(f"Context Length: {len(context)} characters")
+        print(f"Conversation History: {len(conversation_history)} entries")
+        return [_RESPONSE_GUIDELINES_MESSAGE, HumanMessage(content=prompt)]
+    
     async def get_response(self, message: str, conversation_id: Optional[str] = None, agent_id: Optional[str] = None, user_id: Optional[str] = None) -> ChatResponse:
         """Get response using LangChain-style RAG approach similar to Streamlit example"""
         try:
             print(f"\n=== RAG Query Processing ===")
             print(f"Processing message: {message}")
             
-            # Step 0: Get conversation history if conversation_id is provided
-            conversation_history = []
-            if conversation_id:
-                history_data = await self.get_conversation_history(conversation_id)
-                if history_data:
-                    # Convert to format expected by prompt creation
-                    conversation_history = []
-                    for msg in history_data:
-                        if msg.get('sender') == 'user':
-                            conversation_history.append({'message': msg.get('text', ''), 'response': ''})
-                        elif msg.get('sender') == 'bot' and conversation_history:
-                            conversation_history[-1]['response'] = msg.get('text', '')
-                print(f"Retrieved {len(conversation_history)} conversation history entries")
-            
-            # Step 1: Try knowledge base search first
-            chunks = await self._search_knowledge_base(message, agent_id, user_id=user_id)
-            kb_context = self._build_context(chunks) if chunks else ""
-            
-            print(f"Knowledge base results: {len(kb_context)} characters")
-            
-            # Step 2: Always perform web search but determine if links should be included
-            web_results = None
-            web_links = []
-            
-            if self.web_search_tool:
-                print("Performing web search...")
-                web_results = await self._search_web(message)
-                print(f"Web search results: {len(web_results.get('text', ''))} characters, {len(web_results.get('links', []))} links")
-                
-                # Determine if web links should be included in response
-                should_include_links = self._should_include_web_links(message, kb_context, web_results)
-                web_links = web_results.get('links', []) if should_include_links else []
-                
-                if should_include_links:
-                    print(f"Including {len(web_links)} relevant web links in response")
-                else:
-                    print("Web search performed but links not relevant enough to include")
-            else:
-                print("Web search tool not available")
+            retrieved = await self._retrieve(message, conversation_id, agent_id, user_id)
+            chunks = retrieved["chunks"]
+            web_links = retrieved["web_links"]
+            context = retrieved["context"]
             
-            # Step 3: Combine results
-            context = self._build_context(chunks, web_results)
-            
-            if not context:
-                print("No context found for query")
+            if not retrieved["has_context"]:
+                print("No usable context found for query")
                 return ChatResponse(
-                    response="I'm sorry, I couldn't find any relevant information for your query. Please upload relevant technical documentation or try rephrasing your question.",
+                    response=NO_CONTEXT_RESPONSE,
                     sources=[],
                     chunks_found=0
                 )
@@ -399,71 +687,10 @@ I don't have specific technical documentation available for this question. Pleas
             # Step 4: Generate response using LLM if available
             if self.llm:
                 try:
-                    # Get agent-specific instructions if agent_id is provided
-                    agent_instructions = ""
-                    if agent_id and self.agent_service:
-                        agent = await self.agent_service.get_agent(agent_id)
-                        if agent and agent.get('extra_instructions'):
-                            agent_instructions = f"\n\nAGENT-SPECIFIC INSTRUCTIONS:\n{agent['extra_instructions']}"
-                    
-                    # Create optimized chatbot prompt - include links only if they are relevant
-                    links_text = ""
-                    link_guidance = ""
-                    
-                    if web_links:
-                        links_text = "\n\nRELEVANT LINKS (include these when helpful):\n"
-                        for i, link in enumerate(web_links[:3], 1):
-                            links_text += f"{i}. [{link['title']}]({link['url']})\n"
-                        link_guidance = "- When you have relevant links, include them naturally in your response\n"
-                    
-                    # Add conversation history context
-                    history_context = ""
-                    if conversation_history:
-                        history_context = "\n\nCONVERSATION CONTEXT (recent exchanges):\n"
-                        for i, entry in enumerate(conversation_history[-3:], 1):  # Last 3 exchanges
-                            if entry.get('message') and entry.get('response'):
-                                history_context += f"Previous Q{i}: {entry['message'][:100]}...\n"
-                                history_context += f"Previous A{i}: {entry['response'][:100]}...\n\n"
-                    
-                    prompt = f"""You are a friendly technical support chatbot helping maintenance technicians. Provide helpful, conversational answers based on the information below.
-
-Technical Documentation:
-{context}{links_text}{history_context}
-
-Extra instructions for your response:
-{agent_instructions}
-
-User Question: {message}
-
-CHATBOT RESPONSE GUIDELINES:
-- Be conversational and helpful, like talking to a colleague
-- Keep initial answers concise (2-3 sentences) but offer to elaborate
-- Use bullet points for step-by-step instructions
-- Include part numbers and safety warnings when available
-{link_guidance}- If info is incomplete, suggest specific next steps or resources
-- Use friendly language: "Here's what I found...", "You'll want to...", "Let me help with that..."
-- Reference previous conversation when relevant
-- Follow any agent-specific instructions provided above
-
-EXAMPLE RESPONSES:
-Q: "How do I reset the system?"
-To reset the system, press and hold the reset button for 5 seconds - you'll find it on the main control panel (Part #RST-001).
-
-Q: "What's the operating temperature range?"
-The operating range is -10°C to 60°C. Need to know anything specific about temperature monitoring or troubleshooting?
-
-Q: "How do I replace the filter?"
-Here's how to replace the filter:\n\n• **First, turn off power** and unplug the unit for safety\n• Remove the front panel by pressing the two side tabs\n• Slide out the old filter (Part #FLT-200) and dispose of it\n• Insert the new filter until you hear it click into place\n• Reattach the panel and power back up\n\nNeed help finding the right replacement filter or have questions about the process?
-
-Your response:"""
-                    
-                    print(f"\n=== LLM Call ===")
-                    print(f"Prompt Length: {len(prompt)} characters")
-                    print(f"Context Length: {len(context)} characters")
-                    print(f"Conversation History: {len(conversation_history)} entries")
+                    prompt = await self._build_llm_prompt(message, context, web_links, retrieved["conversation_history"], agent_id)
                     
                     # Generate response
-                    response = await asyncio.to_thread(self.llm.invoke, prompt)
+                    response = await self.llm.ainvoke(prompt)
                     response_text = response.content if hasattr(response, 'content') else str(response)
                     
                     print(f"LLM Response Length: {len(response_text)} characters")
@@ -497,11 +724,57 @@ Your response:"""
         except Exception as e:
             print(f"Error in chat service: {e}")
             return ChatResponse(
-                response="I apologize, but I encountered an error while processing your request. Please try again.",
+                response=ERROR_RESPONSE,
                 sources=[],
                 chunks_found=0
             )
     
+    async def stream_response(self, message: str, conversation_id: Optional[str] = None, agent_id: Optional[str] = None, user_id: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Same pipeline as get_response, but yields LLM tokens as they arrive.
+        Yields {"type": "token", "content": ...} events, then one {"type": "done", "sources": ..., "chunks_found": ...}.
+        """
+        chunks, web_links = [], []
+        try:
+            print(f"\n=== RAG Query Processing (streaming) ===")
+            print(f"Processing message: {message}")
+            
+            retrieved = await self._retrieve(message, conversation_id, agent_id, user_id)
+            chunks = retrieved["chunks"]
+            web_links = retrieved["web_links"]
+            context = retrieved["context"]
+            
+            if not retrieved["has_context"]:
+                print("No usable context found for query")
+                yield {"type": "token", "content": NO_CONTEXT_RESPONSE}
+                yield {"type": "done", "sources": [], "chunks_found": 0}
+                return
+            
+            streamed = False
+            if self.llm:
+                try:
+                    prompt = await self._build_llm_prompt(message, context, web_links, retrieved["conversation_history"], agent_id)
+                    async for token in self.llm.astream(prompt):
+                        if token.content:
+                            streamed = True
+                            yield {"type": "token", "content": token.content}
+                    print(f"=== End RAG Processing ===\n")
+                except Exception as e:
+                    print(f"Error streaming LLM response: {e}")
+                    if streamed:
+                        raise
+            
+            # Fallback response when the LLM is unavailable or failed before producing output
+            if not streamed:
+                yield {"type": "token", "content": self._generate_fallback_response(context, message, web_links)}
+            
+            yield {"type": "done", "sources": self._extract_sources(chunks, web_links), "chunks_found": len(chunks)}
+        
+        except Exception as e:
+            print(f"Error in chat service: {e}")
+            yield {"type": "error", "content": ERROR_RESPONSE}
+            yield {"type": "done", "sources": [], "chunks_found": 0}
+    
     def _extract_sources(self, chunks: List[Dict[str, Any]], web_links: List[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """Extract unique source information from chunks and web links"""
         sources = []
@@ -538,7 +811,7 @@ Your response:"""
         """Generate a concise fallback response when LLM is not available"""
         if context:
             # Extract first relevant chunk for quick response
-            lines = context.split('\n')[:5]  # First 5 lines
+            lines = context.split('\n', 5)[:5]  # First 5 lines, without splitting the rest of the context
             summary = ' '.join(lines).strip()[:300]
             response = f"Here's what I found: {summary}..."
             
@@ -563,8 +836,14 @@ Your response:"""
             
             return response
     
+    async def close(self):
+        """Close the pooled HTTP client and the Redis connection"""
+        await self._http_client.aclose()
+        if self._redis:
+            await self._redis.aclose()
+    
     def clear_cache(self):
-        """Clear the query cache"""
+        """Clear the in-process query cache (Redis entries expire on their TTL)"""
         self._query_cache.clear()
         print("Query cache cleared")
     
@@ -573,7 +852,13 @@ Your response:"""
         Get conversation history from Supabase
         """
         try:
-            result = self.supabase.table("messages").select("*").eq("conversation_id", conversation_id).order("timestamp").execute()
+            # The conversation service keeps recent conversations' messages in memory
+            if self.conversation_service:
+                return await self.conversation_service.get_message_rows(conversation_id)
+            
+            # Run the blocking Supabase request in a thread so it overlaps with the searches
+            query = self.supabase.table("messages").select("*").eq("conversation_id", conversation_id).order("timestamp")
+            result = await asyncio.to_thread(query.execute)
             return result.data if result.data else []
         except Exception as e:
             print(f"Error retrieving conversation history: {e}")
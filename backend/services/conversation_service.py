@@ -1,14 +1,79 @@
+import os
+import time
+import asyncio
 import uuid
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 from config.supabase_client import get_supabase_client
 from models.schemas import Conversation, ConversationMessage, ConversationHistory
 
+CONVERSATION_COLUMNS = "id, agent_name, title, created_at, updated_at, message_count"
+
 class ConversationService:
     def __init__(self):
         self.supabase = get_supabase_client()
+        
+        # Message rows of recently active conversations, loaded on first read and kept current
+        # by add_message, so each chat turn doesn't re-read the whole history from the database.
+        # The cache is per process: other workers' writes don't reach it, so entries expire after
+        # MESSAGE_CACHE_TTL_SECONDS and it is off entirely when running more than one worker.
+        self._message_cache: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._message_cache_size = 256 if int(os.getenv("WEB_CONCURRENCY", "1")) <= 1 else 0
+        self._message_cache_ttl = float(os.getenv("MESSAGE_CACHE_TTL_SECONDS", "30"))
+        self._cache_lock = asyncio.Lock()
+        # Conversations being loaded; set to False when a write lands mid-load so the stale rows aren't cached
+        self._loading: Dict[str, bool] = {}
+        # Cleared when the database lacks add_conversation_message (migrations/005 not applied)
+        self._message_rpc_available = True
         print("ConversationService initialized with Supabase")
     
+    async def get_message_rows(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """Get a conversation's message rows in timestamp order, from the cache when possible"""
+        async with self._cache_lock:
+            entry = self._message_cache.get(conversation_id)
+            if entry is not None:
+                if time.monotonic() - entry[0] < self._message_cache_ttl:
+                    self._message_cache.move_to_end(conversation_id)
+                    return list(entry[1])
+                del self._message_cache[conversation_id]
+            self._loading[conversation_id] = True
+        
+        try:
+            query = self.supabase.table("messages").select("*").eq("conversation_id", conversation_id).order("timestamp")
+            result = await asyncio.to_thread(query.execute)
+            rows = result.data if result.data else []
+        except Exception:
+            async with self._cache_lock:
+                self._loading.pop(conversation_id, None)
+            raise
+        
+        async with self._cache_lock:
+            if self._loading.pop(conversation_id, False) and conversation_id not in self._message_cache and self._message_cache_size > 0:
+                self._message_cache[conversation_id] = (time.monotonic(), list(rows))
+                while len(self._message_cache) > self._message_cache_size:
+                    self._message_cache.popitem(last=False)
+        return rows
+    
+    async def _cache_message(self, conversation_id: str, row: Optional[Dict[str, Any]]):
+        """Append a newly stored message to its conversation's cached rows, if cached"""
+        async with self._cache_lock:
+            if conversation_id in self._loading:
+                self._loading[conversation_id] = False
+            if conversation_id in self._message_cache:
+                if row:
+                    self._message_cache[conversation_id][1].append(row)
+                    self._message_cache.move_to_end(conversation_id)
+                else:
+                    del self._message_cache[conversation_id]
+    
+    async def _evict_messages(self, conversation_ids: List[str]):
+        async with self._cache_lock:
+            for conversation_id in conversation_ids:
+                self._message_cache.pop(conversation_id, None)
+                if conversation_id in self._loading:
+                    self._loading[conversation_id] = False
+    
     def _get_conversations_for_user(self, user_id: str = None) -> List[Dict[str, Any]]:
         """Get conversations from Supabase, optionally filtered by user_id"""
         try:
@@ -34,14 +99,15 @@ class ConversationService:
         try:
             conversation_id = str(uuid.uuid4())
             title = self._generate_conversation_title(first_message)
+            now = datetime.utcnow().isoformat()
             
             conversation_data = {
                 "id": conversation_id,
                 "user_id": user_id,
                 "agent_name": agent_name,
                 "title": title,
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
+                "created_at": now,
+                "updated_at": now
             }
             
             result = self.supabase.table("conversations").insert(conversation_data).execute()
@@ -59,19 +125,47 @@ class ConversationService:
     async def add_message(self, conversation_id: str, text: str, sender: str, agent_name: str = None, user_id: str = None) -> str:
         """Add a message to a conversation"""
         try:
+            message_id = str(uuid.uuid4())
+            
+            # add_conversation_message (migrations/005) checks the conversation, inserts the
+            # message and bumps updated_at/message_count in one transaction. Once it is found
+            # missing, later messages go straight to the separate queries below
+            if self._message_rpc_available:
+                try:
+                    result = self.supabase.rpc("add_conversation_message", {
+                        "p_message_id": message_id,
+                        "p_conversation_id": conversation_id,
+                        "p_text": text,
+                        "p_sender": sender,
+                        "p_agent_name": agent_name
+                    }).execute()
+                    row = result.data[0] if isinstance(result.data, list) and result.data else result.data
+                    await self._cache_message(conversation_id, row if isinstance(row, dict) else None)
+                    return message_id
+                except Exception as e:
+                    code = getattr(e, "code", None)
+                    if code == "P0002":
+                        raise ValueError(f"Conversation '{conversation_id}' not found")
+                    # Only fall back when the function isn't installed; any other error may come after
+                    # the RPC committed, and inserting again would duplicate the message
+                    if code not in ("PGRST202", "42883"):
+                        raise
+                    print(f"add_conversation_message RPC unavailable, falling back to separate queries: {e}")
+                    self._message_rpc_available = False
+            
             # Check if conversation exists
             conv_result = self.supabase.table("conversations").select("id").eq("id", conversation_id).execute()
             if not conv_result.data:
                 raise ValueError(f"Conversation '{conversation_id}' not found")
             
-            message_id = str(uuid.uuid4())
+            now = datetime.utcnow().isoformat()
             message_data = {
                 "id": message_id,
                 "conversation_id": conversation_id,
                 "text": text,
                 "sender": sender,
                 "agent_name": agent_name,
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": now
             }
             
             # Insert message
@@ -80,9 +174,10 @@ class ConversationService:
             if result.data:
                 # Update conversation's updated_at timestamp
                 self.supabase.table("conversations").update({
-                    "updated_at": datetime.utcnow().isoformat()
+                    "updated_at": now
                 }).eq("id", conversation_id).execute()
                 
+                await self._cache_message(conversation_id, result.data[0])
                 return message_id
             else:
                 raise Exception("Failed to add message to database")
@@ -95,7 +190,7 @@ class ConversationService:
         """Get full conversation history"""
         try:
             # Get conversation data
-            conv_query = self.supabase.table("conversations").select("*").eq("id", conversation_id)
+            conv_query = self.supabase.table("conversations").select(CONVERSATION_COLUMNS).eq("id", conversation_id)
             
             conv_result = conv_query.execute()
             if not conv_result.data:
@@ -104,13 +199,10 @@ class ConversationService:
             conversation_data = conv_result.data[0]
             
             # Get messages
-            msg_query = self.supabase.table("messages").select("*").eq("conversation_id", conversation_id)
+            conversation_messages = await self.get_message_rows(conversation_id)
             
-            msg_result = msg_query.order("timestamp").execute()
-            conversation_messages = msg_result.data if msg_result.data else []
-            
-            # Convert to schema objects
-            conversation = Conversation(**conversation_data)
+            # Convert to schema objects; rows come from our own tables, so skip re-validating them
+            conversation = Conversation.model_construct(**conversation_data)
             message_objects = []
             for msg in conversation_messages:
                 # Map database fields to schema fields
@@ -122,9 +214,9 @@ class ConversationService:
                     "agent_name": msg["agent_name"],
                     "conversation_id": msg["conversation_id"]
                 }
-                message_objects.append(ConversationMessage(**msg_data))
+                message_objects.append(ConversationMessage.model_construct(**msg_data))
             
-            return ConversationHistory(
+            return ConversationHistory.model_construct(
                 conversation=conversation,
                 messages=message_objects
             )
@@ -136,15 +228,17 @@ class ConversationService:
     async def get_agent_conversations(self, agent_name: str, user_id: str = None) -> List[Conversation]:
         """Get all conversations for a specific agent"""
         try:
-            query = self.supabase.table("conversations").select("*").eq("agent_name", agent_name)
+            # Only fetch the columns Conversation has; filtering and ordering happen in the database
+            query = self.supabase.table("conversations").select(CONVERSATION_COLUMNS).eq("agent_name", agent_name)
             if user_id:
                 query = query.eq("user_id", user_id)
             
             result = query.order("updated_at", desc=True).execute()
             
+            # Rows come straight from our own table, so skip re-validating every field
             agent_conversations = []
             for conv_data in result.data if result.data else []:
-                agent_conversations.append(Conversation(**conv_data))
+                agent_conversations.append(Conversation.model_construct(**conv_data))
             
             return agent_conversations
             
@@ -169,6 +263,7 @@ class ConversationService:
             # Delete conversation
             conv_delete_query = self.supabase.table("conversations").delete().eq("id", conversation_id)
             conv_delete_query.execute()
+            await self._evict_messages([conversation_id])
             
             print(f"Deleted conversation '{conversation_id}'")
             return True
@@ -180,10 +275,7 @@ class ConversationService:
     async def get_conversation_messages(self, conversation_id: str, user_id: str = None) -> List[ConversationMessage]:
         """Get all messages for a conversation"""
         try:
-            query = self.supabase.table("messages").select("*").eq("conversation_id", conversation_id)
-            
-            result = query.order("timestamp").execute()
-            conversation_messages = result.data if result.data else []
+            conversation_messages = await self.get_message_rows(conversation_id)
             
             message_objects = []
             for msg in conversation_messages:
@@ -196,7 +288,7 @@ class ConversationService:
                     "agent_name": msg["agent_name"],
                     "conversation_id": msg["conversation_id"]
                 }
-                message_objects.append(ConversationMessage(**msg_data))
+                message_objects.append(ConversationMessage.model_construct(**msg_data))
             
             return message_objects
             
@@ -204,6 +296,39 @@ class ConversationService:
             print(f"Error getting conversation messages: {e}")
             return []
     
+    async def search_messages(self, agent_name: str, query: str, user_id: str = None, limit: int = 20) -> List[ConversationMessage]:
+        """Full-text search over one user's messages with an agent, best matches first"""
+        if not user_id:
+            return []
+        
+        try:
+            # search_messages (migrations/006) matches against a GIN full-text index
+            result = self.supabase.rpc("search_messages", {
+                "p_agent_name": agent_name,
+                "p_query": query,
+                "p_user_id": user_id,
+                "p_limit": limit
+            }).execute()
+            
+            message_objects = []
+            for msg in result.data if result.data else []:
+                # Map database fields to schema fields
+                msg_data = {
+                    "id": msg["id"],
+                    "text": msg["text"],
+                    "sender": msg["sender"],
+                    "timestamp": msg["timestamp"],
+                    "agent_name": msg["agent_name"],
+                    "conversation_id": msg["conversation_id"]
+                }
+                message_objects.append(ConversationMessage.model_construct(**msg_data))
+            
+            return message_objects
+            
+        except Exception as e:
+            print(f"Error searching messages: {e}")
+            return []
+    
     async def delete_agent_conversations(self, agent_name: str, user_id: str = None) -> int:
         """Delete all conversations for a specific agent"""
         try:
@@ -224,6 +349,8 @@ class ConversationService:
                 self.supabase.table("conversations").delete().eq("id", conversation_id).execute()
                 deleted_count += 1
             
+            await self._evict_messages(conversation_ids)
+            
             if deleted_count > 0:
                 print(f"Deleted {deleted_count} conversations for agent '{agent_name}'")
             
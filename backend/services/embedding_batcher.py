@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent embedding requests into shared batches.
+    Callers await encode()/encode_many(); a background task gathers queued texts for up to
+    max_latency_ms (or until max_batch_size) and sends them to the embedding function in one call.
+    Embeddings are remembered by content hash, so repeated texts never reach the embedding function.
+    """
+    
+    def __init__(self, embed_fn: Callable[[List[str]], List[List[float]]], max_batch_size: int = 100, max_latency_ms: float = 8, max_concurrency: int = 4, cache_size: Optional[int] = None):
+        # embed_fn is blocking (an HTTP client call) and is run in a worker thread
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.max_concurrency = max_concurrency
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: Set[asyncio.Task] = set()
+        
+        # LRU of content hash -> embedding; 0 disables it. Embeddings are kept as float32 arrays
+        # (6 KB for 1536 dimensions, against ~49 KB as a list of Python floats)
+        if cache_size is None:
+            cache_size = int(os.getenv('EMBEDDING_CACHE_SIZE', '4096'))
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+    
+    def _ensure_worker(self):
+        """Start the batching task on first use, inside the running event loop"""
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._semaphore = self._semaphore or asyncio.Semaphore(self.max_concurrency)
+            self._worker = asyncio.create_task(self._run())
+    
+    async def encode(self, text: str) -> List[float]:
+        """Embed a single text"""
+        return (await self.encode_many([text]))[0]
+    
+    async def encode_many(self, texts: List[str]) -> List[List[float]]:
+        """Embed several texts, preserving order"""
+        if not texts:
+            return []
+        
+        keys = [hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest() for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        
+        # Only texts not seen before are queued, and each distinct one only once
+        misses: Dict[bytes, List[int]] = {}
+        for i, key in enumerate(keys):
+            embedding = self._cache.get(key)
+            if embedding is not None:
+                self._cache.move_to_end(key)
+                results[i] = embedding.tolist()
+            else:
+                misses.setdefault(key, []).append(i)
+        
+        if misses:
+            self._ensure_worker()
+            loop = asyncio.get_running_loop()
+            futures = []
+            for positions in misses.values():
+                future = loop.create_future()
+                self._queue.put_nowait((texts[positions[0]], future))
+                futures.append(future)
+            
+            embeddings = await asyncio.gather(*futures)
+            for (key, positions), embedding in zip(misses.items(), embeddings):
+                self._remember(key, embedding)
+                for i in positions:
+                    results[i] = embedding
+        
+        return results
+    
+    def _remember(self, key: bytes, embedding: List[float]):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = np.asarray(embedding, dtype=np.float32)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_latency
+            
+            # Fill the batch until it is full or the latency window closes
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Dispatch without waiting so the next batch can form while this one is in flight
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+    
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            embeddings = await asyncio.to_thread(self.embed_fn, [text for text, _ in batch])
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._semaphore.release()
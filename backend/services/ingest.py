@@ -0,0 +1,195 @@
+import os
+import re
+import uuid
+import orjson
+import asyncio
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+import aiofiles
+from fastapi import UploadFile
+from services.pdf_parser import PDFParserService
+from config.paths import UPLOAD_DIR, PARSED_DIR, DATA_DIR
+
+# Size of each read when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+def _safe_filename(name: str) -> str:
+    """Strip directory components and replace anything outside a conservative allowlist"""
+    name = os.path.basename(name.replace("\\", "/"))
+    return re.sub(r"[^A-Za-z0-9._-]", "_", name).lstrip(".") or "upload.pdf"
+
+def _sendfile_copy(src_fd: int, file_path: str) -> Tuple[int, str]:
+    """Copy a spooled upload with os.sendfile so the bytes never pass through Python"""
+    total = os.fstat(src_fd).st_size
+    offset = 0
+    dst_fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while offset < total:
+            sent = os.sendfile(dst_fd, src_fd, offset, UPLOAD_CHUNK_SIZE)
+            if sent == 0:
+                break
+            offset += sent
+    finally:
+        os.close(dst_fd)
+    
+    # Hash from the freshly written file, which is still in the page cache
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for buf in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(buf)
+    return offset, digest.hexdigest()
+
+async def _atomic_write(path, data: bytes):
+    """Write a file in one call to a temp file and swap it in, so a crash never leaves it truncated"""
+    tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        async with aiofiles.open(tmp_file, 'wb') as f:
+            await f.write(data)
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+class IngestService:
+    """Shared upload pipeline: stream to disk, parse (or reuse a cached parse) and persist chunks"""
+    
+    def __init__(self, pdf_parser: PDFParserService, parse_concurrency: int = 6, cpu_workers: int = 4, parse_cache_file: Path = DATA_DIR / "parse_cache.json"):
+        self.pdf_parser = pdf_parser
+        
+        # Bounds LlamaParse API concurrency across all uploads
+        self.parse_semaphore = asyncio.Semaphore(parse_concurrency)
+        
+        # Keeps hashing and serialization of large uploads off the event loop
+        self.cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="ingest")
+        
+        # Content-hash cache of parsed PDFs: sha256 -> parsed JSON path
+        self.parse_cache_file = Path(parse_cache_file)
+        self._parse_cache_lock = asyncio.Lock()
+        self._parse_cache = self._load_parse_cache()
+    
+    def _load_parse_cache(self) -> Dict[str, str]:
+        """Load the parse cache index from disk"""
+        try:
+            with open(self.parse_cache_file, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Error loading parse cache: {e}")
+            return {}
+    
+    async def _get_cached_chunks(self, sha256: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+        """Return previously parsed chunks for identical file content, if any"""
+        if not sha256:
+            return None
+        
+        async with self._parse_cache_lock:
+            parsed_file = self._parse_cache.get(sha256)
+        if not parsed_file or not Path(parsed_file).exists():
+            return None
+        
+        try:
+            async with aiofiles.open(parsed_file, 'rb') as f:
+                return orjson.loads(await f.read())
+        except Exception as e:
+            print(f"Error reading cached parse {parsed_file}: {e}")
+            return None
+    
+    async def _record_parsed_file(self, sha256: Optional[str], parsed_file: str):
+        """Remember where the parsed chunks for this file content were saved"""
+        if not sha256:
+            return
+        
+        async with self._parse_cache_lock:
+            self._parse_cache[sha256] = parsed_file
+            await _atomic_write(self.parse_cache_file, orjson.dumps(self._parse_cache))
+    
+    async def _write_upload(self, file: UploadFile, file_path: str) -> Tuple[int, str]:
+        """Stream an uploaded file to disk in fixed-size chunks, returning its size and SHA-256"""
+        loop = asyncio.get_running_loop()
+        
+        # Large uploads are spooled to a temp file; let the kernel copy those (Linux only)
+        if hasattr(os, "sendfile") and getattr(file.file, "_rolled", False):
+            await file.seek(0)
+            return await loop.run_in_executor(None, _sendfile_copy, file.file.fileno(), file_path)
+        
+        size = 0
+        digest = hashlib.sha256()
+        async with aiofiles.open(file_path, 'wb') as f:
+            while True:
+                buf = await file.read(UPLOAD_CHUNK_SIZE)
+                if not buf:
+                    break
+                await f.write(buf)
+                await loop.run_in_executor(self.cpu_pool, digest.update, buf)
+                size += len(buf)
+        return size, digest.hexdigest()
+    
+    async def save_upload(self, file: UploadFile, agent_name: Optional[str] = None) -> Dict[str, Any]:
+        """Save an uploaded PDF under uploads/ and describe it for parsing"""
+        # A random component keeps concurrent uploads of the same name from clobbering each other
+        prefix = f"{_safe_filename(agent_name)}_" if agent_name else ""
+        file_path = str(UPLOAD_DIR / f"{prefix}{uuid.uuid4().hex}_{_safe_filename(file.filename)}")
+        file_size, sha256 = await self._write_upload(file, file_path)
+        
+        return {
+            "filename": file.filename,
+            "file_path": file_path,
+            "file_size": file_size,
+            "sha256": sha256
+        }
+    
+    async def parse(self, file_data: Dict[str, Any], agent_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Parse a saved PDF into chunks, reusing an earlier parse of identical content"""
+        filename = file_data["filename"]
+        file_path = file_data["file_path"]
+        sha256 = file_data.get("sha256")
+        
+        async with self.parse_semaphore:
+            chunks = await self._get_cached_chunks(sha256)
+            if chunks:
+                print(f"Parse cache hit for {filename}")
+                file_data["parsed_file"] = self._parse_cache.get(sha256)
+                # The cached chunks describe the earlier upload; give them fresh IDs so indexing
+                # this copy doesn't overwrite the vectors already stored for that file
+                upload_time = datetime.now().isoformat()
+                for chunk in chunks:
+                    chunk_id = uuid.uuid4().hex
+                    chunk["chunk_id"] = chunk_id
+                    metadata = chunk.setdefault("metadata", {})
+                    metadata.update({
+                        "filename": filename,
+                        "file_path": file_path,
+                        "upload_time": upload_time,
+                        "chunk_id": chunk_id
+                    })
+                return chunks
+            
+            chunks = await self.pdf_parser.parse_pdf(file_path, filename)
+            if not chunks:
+                return []
+            
+            # Save parsed chunks
+            prefix = f"{_safe_filename(agent_name)}_" if agent_name else ""
+            parsed_file = str(PARSED_DIR / f"{prefix}{Path(file_path).stem}_parsed.json")
+            data = await asyncio.get_running_loop().run_in_executor(self.cpu_pool, orjson.dumps, chunks)
+            # Reindexing and the parse cache read these files, so never expose a partial one
+            await _atomic_write(parsed_file, data)
+            await self._record_parsed_file(sha256, parsed_file)
+            
+            file_data["parsed_file"] = parsed_file
+            return chunks
+    
+    async def ingest_pdf(self, file: UploadFile, agent_name: Optional[str] = None) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Save and parse one uploaded PDF"""
+        file_data = await self.save_upload(file, agent_name)
+        chunks = await self.parse(file_data, agent_name)
+        return file_data, chunks
+    
+    def close(self):
+        """Release the worker threads"""
+        self.cpu_pool.shutdown(wait=False)
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+class JobTracker:
+    """Bounded, LRU-ordered store for background upload job state"""
+    
+    FINISHED_STATUSES = ("completed", "failed")
+    
+    def __init__(self, max_jobs: int = 1024, ttl_seconds: int = 24 * 60 * 60):
+        self.max_jobs = max_jobs
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._jobs
+    
+    def __len__(self) -> int:
+        return len(self._jobs)
+    
+    def __getitem__(self, job_id: str) -> Dict[str, Any]:
+        job = self._jobs[job_id]
+        self._jobs.move_to_end(job_id)
+        return job
+    
+    def __setitem__(self, job_id: str, job: Dict[str, Any]):
+        self._jobs[job_id] = job
+        self._jobs.move_to_end(job_id)
+        self._evict()
+    
+    def get(self, job_id: str, default: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        if job_id not in self._jobs:
+            return default
+        return self[job_id]
+    
+    def _evict(self):
+        """Drop least recently used finished jobs until under the size limit"""
+        if len(self._jobs) <= self.max_jobs:
+            return
+        
+        # Jobs still processing are never evicted; the background task writes to them
+        for job_id in [jid for jid, job in self._jobs.items() if job.get("status") in self.FINISHED_STATUSES]:
+            if len(self._jobs) <= self.max_jobs:
+                break
+            del self._jobs[job_id]
+    
+    def prune_expired(self) -> int:
+        """Remove finished jobs whose completed_at is older than the TTL"""
+        cutoff = datetime.now() - self.ttl
+        expired = []
+        
+        for job_id, job in self._jobs.items():
+            completed_at = job.get("completed_at")
+            if not completed_at:
+                continue
+            try:
+                if datetime.fromisoformat(completed_at) < cutoff:
+                    expired.append(job_id)
+            except ValueError:
+                expired.append(job_id)
+        
+        for job_id in expired:
+            del self._jobs[job_id]
+        
+        return len(expired)
@@ -1,13 +1,21 @@
 import os
-import json
+import orjson
 import asyncio
-from typing import List, Dict, Any, Optional
+import aiofiles
+import ijson
+from collections import Counter
+from typing import List, Dict, Any, Optional, Set
 from datetime import datetime
 from pathlib import Path
 from pinecone import Pinecone, ServerlessSpec
 from openai import OpenAI
 import uuid
 import time
+from config.paths import PARSED_DIR, DATA_DIR
+from services.embedding_batcher import EmbeddingBatcher
+from services.semantic_cache import SemanticQueryCache, SEMANTIC_CACHE_TTL_SECONDS
+from services.upsert_batcher import UpsertBatcher
+from services.vector_delete import delete_ids_by_filter
 
 class KnowledgeBaseService:
     def __init__(self):
@@ -28,6 +36,28 @@ class KnowledgeBaseService:
         self.index_name = "mechagent-knowledge-base"
         self.dimension = 1536  # OpenAI text-embedding-ada-002 dimension
         self.embedding_model = "text-embedding-ada-002"
+        self.reindex_batch_size = 256
+        
+        # Search results keyed by query embedding so paraphrased questions skip Pinecone
+        self.query_cache = SemanticQueryCache(
+            threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95')),
+            max_entries=1024,
+            ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS
+        )
+        
+        # Concurrent embedding calls (searches, ingests) share OpenAI requests
+        self.embedding_batcher = EmbeddingBatcher(self._embed_texts, max_batch_size=100, max_latency_ms=8)
+        
+        # Concurrent ingests share Pinecone upsert requests
+        self.upsert_batcher = UpsertBatcher(self._upsert_vectors, max_batch_size=100, max_latency_ms=50)
+        
+        # Chunks per filename, kept alongside the index since Pinecone can't count distinct metadata values.
+        # This assumes a single writer: workers re-read the file before each change, which narrows but
+        # doesn't close the window for concurrent updates, so counts can drift under WEB_CONCURRENCY > 1.
+        # reindex_all rebuilds them from scratch.
+        self.file_counts_file = DATA_DIR / "knowledge_base_files.json"
+        self._file_counts = self._load_file_counts()
+        self._file_counts_lock = asyncio.Lock()
         
         # Create or connect to index
         self._setup_index()
@@ -61,19 +91,64 @@ class KnowledgeBaseService:
             print(f"Error setting up Pinecone index: {e}")
             raise
     
+    def _load_file_counts(self) -> Counter:
+        try:
+            if self.file_counts_file.exists():
+                return Counter(orjson.loads(self.file_counts_file.read_bytes()))
+        except Exception as e:
+            print(f"Error loading knowledge base file counts: {e}")
+        return Counter()
+    
+    def _write_file_counts(self, data: bytes):
+        # Write to a temp file and swap it in so a crash never leaves a truncated file
+        tmp_file = self.file_counts_file.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, self.file_counts_file)
+    
+    async def _update_file_counts(self, added: Optional[Counter] = None, removed: Optional[str] = None, reset: bool = False):
+        """Apply chunk count changes per filename and persist them"""
+        try:
+            async with self._file_counts_lock:
+                # Pick up changes other workers have written since we last loaded the file
+                self._file_counts = await asyncio.to_thread(self._load_file_counts)
+                if reset:
+                    self._file_counts.clear()
+                if added:
+                    self._file_counts.update(added)
+                if removed:
+                    self._file_counts.pop(removed, None)
+                await asyncio.to_thread(self._write_file_counts, orjson.dumps(self._file_counts))
+        except Exception as e:
+            print(f"Error saving knowledge base file counts: {e}")
+    
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch of texts with one OpenAI request (blocking; called by the batcher)"""
+        response = self.openai_client.embeddings.create(
+            input=texts,
+            model=self.embedding_model
+        )
+        return [item.embedding for item in response.data]
+    
+    def _upsert_vectors(self, vectors: List[Dict[str, Any]], namespace: str):
+        """Upsert one batch of vectors (blocking; called by the upsert batcher)"""
+        self.index.upsert(vectors=vectors, namespace=namespace)
+    
     async def _generate_embedding(self, text: str) -> List[float]:
         """Generate embedding using OpenAI API"""
         try:
-            response = await asyncio.to_thread(
-                self.openai_client.embeddings.create,
-                input=text,
-                model=self.embedding_model
-            )
-            return response.data[0].embedding
+            return await self.embedding_batcher.encode(text)
         except Exception as e:
             print(f"Error generating embedding: {e}")
             raise
     
+    async def _generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for many texts, batched into shared OpenAI requests"""
+        try:
+            return await self.embedding_batcher.encode_many(texts)
+        except Exception as e:
+            print(f"Error generating embeddings: {e}")
+            raise
+    
     async def add_chunks(self, chunks: List[Dict[str, Any]]) -> int:
         """
         Add text chunks to the knowledge base with embeddings
@@ -90,7 +165,7 @@ class KnowledgeBaseService:
                 if not text:
                     continue
                 
-                chunk_id = chunk.get('chunk_id') or str(uuid.uuid4())
+                chunk_id = chunk.get('chunk_id') or uuid.uuid4().hex
                 metadata = chunk.get('metadata', {})
                 
                 # Ensure metadata is compatible with Pinecone
@@ -98,27 +173,27 @@ class KnowledgeBaseService:
                 # Add the text to metadata for retrieval
                 clean_metadata['text'] = text
                 
-                # Generate embedding using OpenAI
-                embedding = await self._generate_embedding(text)
-                
                 vectors_to_upsert.append({
                     'id': chunk_id,
-                    'values': embedding,
                     'metadata': clean_metadata
                 })
             
             if not vectors_to_upsert:
                 return 0
             
-            # Upsert vectors to Pinecone in batches
-            batch_size = 100
-            total_upserted = 0
+            # Generate all embeddings together, batched into shared OpenAI requests
+            embeddings = await self._generate_embeddings([vector['metadata']['text'] for vector in vectors_to_upsert])
+            for vector, embedding in zip(vectors_to_upsert, embeddings):
+                vector['values'] = embedding
             
-            for i in range(0, len(vectors_to_upsert), batch_size):
-                batch = vectors_to_upsert[i:i + batch_size]
-                self.index.upsert(vectors=batch)
-                total_upserted += len(batch)
+            # Upsert vectors to Pinecone; the batcher splits them into requests of 100
+            # and sends several at once, so a whole reindex batch goes out together
+            total_upserted = await self.upsert_batcher.upsert("", vectors_to_upsert)
+            await self._update_file_counts(added=Counter(
+                vector['metadata']['filename'] for vector in vectors_to_upsert if vector['metadata'].get('filename')
+            ))
             
+            self.query_cache.clear()
             print(f"Added {total_upserted} chunks to Pinecone knowledge base")
             return total_upserted
             
@@ -134,8 +209,15 @@ class KnowledgeBaseService:
             # Generate query embedding using OpenAI
             query_embedding = await self._generate_embedding(query)
             
+            # Reuse results of a near-identical earlier query
+            cached_results = self.query_cache.lookup("", top_k, query_embedding)
+            if cached_results is not None:
+                print(f"Semantic cache hit for query: {query[:50]}...")
+                return cached_results
+            
             # Search Pinecone
-            results = self.index.query(
+            results = await asyncio.to_thread(
+                self.index.query,
                 vector=query_embedding,
                 top_k=top_k,
                 include_metadata=True
@@ -154,6 +236,7 @@ class KnowledgeBaseService:
                     "rank": i + 1
                 })
             
+            self.query_cache.add("", top_k, query_embedding, search_results)
             return search_results
             
         except Exception as e:
@@ -170,30 +253,44 @@ class KnowledgeBaseService:
             # or recreate the index if needed
             try:
                 # Get all vector IDs and delete them
-                stats = self.index.describe_index_stats()
+                stats = await asyncio.to_thread(self.index.describe_index_stats)
                 if stats['total_vector_count'] > 0:
                     # For simplicity, we'll delete and recreate the index
                     self.pc.delete_index(self.index_name)
                     self._setup_index()
+                    self.query_cache.clear()
             except Exception as e:
                 print(f"Warning: Could not clear existing index: {e}")
             
+            # Rebuild the file counts from what this reindex adds
+            await self._update_file_counts(reset=True)
+            
             # Load all parsed files
-            parsed_dir = Path("parsed")
+            parsed_dir = PARSED_DIR
             total_chunks = 0
             
             if parsed_dir.exists():
+                # Stream chunks out of each file's JSON array and index them in fixed-size batches
+                # that span file boundaries: memory use is bounded by the batch rather than the file,
+                # and small files share embedding and upsert requests instead of each sending their own
+                batch, batch_files = [], set()
                 for json_file in parsed_dir.glob("*_parsed.json"):
                     try:
-                        with open(json_file, 'r', encoding='utf-8') as f:
-                            chunks = json.load(f)
-                        
-                        added_count = await self.add_chunks(chunks)
-                        total_chunks += added_count
+                        async with aiofiles.open(json_file, 'rb') as f:
+                            async for chunk in ijson.items(f, 'item', use_float=True):
+                                batch.append(chunk)
+                                batch_files.add(json_file.name)
+                                if len(batch) >= self.reindex_batch_size:
+                                    pending, pending_files = batch, batch_files
+                                    batch, batch_files = [], set()
+                                    total_chunks += await self._reindex_batch(pending, pending_files)
                         
                     except Exception as e:
-                        print(f"Error processing {json_file}: {e}")
+                        print(f"Error reading {json_file}: {e}")
                         continue
+                
+                if batch:
+                    total_chunks += await self._reindex_batch(batch, batch_files)
             
             print(f"Reindexed {total_chunks} chunks from parsed files")
             return total_chunks
@@ -202,25 +299,28 @@ class KnowledgeBaseService:
             print(f"Error during reindexing: {e}")
             raise
     
+    async def _reindex_batch(self, batch: List[Dict[str, Any]], files: Set[str]) -> int:
+        """Index one reindex batch, retrying once; a failure is reported against every file the batch covers"""
+        for attempt in range(2):
+            try:
+                return await self.add_chunks(batch)
+            except Exception as e:
+                print(f"Error indexing {len(batch)} chunks from {', '.join(sorted(files))} (attempt {attempt + 1}): {e}")
+        return 0
+    
     async def get_stats(self) -> Dict[str, Any]:
         """
         Get knowledge base statistics
         """
         try:
             # Get index stats
-            stats = self.index.describe_index_stats()
-            
-            # Get unique files by querying metadata
-            # Note: This is a simplified approach. In production, you might want to
-            # maintain a separate metadata store for more efficient stats
-            unique_files = set()
-            
-            # For now, we'll estimate based on available stats
-            # In a production setup, you might want to maintain file counts separately
+            stats = await asyncio.to_thread(self.index.describe_index_stats)
+            # Read the shared file rather than this worker's copy, which may miss other workers' changes
+            file_counts = await asyncio.to_thread(self._load_file_counts)
             
             return {
                 "total_chunks": stats.get('total_vector_count', 0),
-                "total_files": "estimated",  # Pinecone doesn't provide easy file counting
+                "total_files": len(file_counts),  # maintained by add_chunks/delete_by_filename
                 "index_name": self.index_name,
                 "embedding_model": "all-MiniLM-L6-v2",
                 "dimension": self.dimension,
@@ -266,39 +366,14 @@ class KnowledgeBaseService:
         Delete all chunks associated with a specific filename
         """
         try:
-            # Query vectors with the specified filename
-            # Note: Pinecone doesn't support direct metadata filtering for deletion
-            # We need to query first, then delete by IDs
-            
-            # This is a simplified approach - in production you might want to
-            # maintain a mapping of filenames to vector IDs
+            # The knowledge base uses the index's default namespace
+            deleted_count = await delete_ids_by_filter(self.index, "", {"filename": filename}, self.dimension)
             
-            # Query to find vectors with this filename
-            # Since we can't directly filter by metadata in query, we'll use a dummy vector
-            dummy_vector = [0.0] * self.dimension
+            if deleted_count:
+                self.query_cache.clear()
+                await self._update_file_counts(removed=filename)
             
-            results = self.index.query(
-                vector=dummy_vector,
-                top_k=10000,  # Large number to get all results
-                include_metadata=True,
-                filter={"filename": filename}
-            )
-            
-            if results['matches']:
-                ids_to_delete = [match['id'] for match in results['matches']]
-                
-                # Delete in batches
-                batch_size = 1000
-                total_deleted = 0
-                
-                for i in range(0, len(ids_to_delete), batch_size):
-                    batch_ids = ids_to_delete[i:i + batch_size]
-                    self.index.delete(ids=batch_ids)
-                    total_deleted += len(batch_ids)
-                
-                return total_deleted
-            
-            return 0
+            return deleted_count
             
         except Exception as e:
             print(f"Error deleting chunks for {filename}: {e}")
@@ -1,22 +1,138 @@
 import os
+import re
 import asyncio
 from typing import List, Dict, Any
-from llama_cloud_services import LlamaParse
-from llama_index.core import Document
-from llama_index.core.node_parser import SentenceSplitter
 from datetime import datetime
 import uuid
 from pathlib import Path
 
+# Markdown line markers, matched over a whole chunk at once (MULTILINE) instead of line by line
+_HEADER_LINE_RE = re.compile(r'^#+', re.MULTILINE)
+_LIST_LINE_RE = re.compile(r'^[^\S\n]*(?:[*-]|[123]\.)', re.MULTILINE)
+
+def _build_text_splitter():
+    from llama_index.core.node_parser import SentenceSplitter
+    
+    # Initialize text splitter optimized for markdown content
+    return SentenceSplitter(
+        chunk_size=1500,  # Larger chunks for better context in RAG
+        chunk_overlap=300,  # More overlap to preserve relationships
+        separator="\n\n",  # Split on paragraph breaks for markdown
+        paragraph_separator="\n\n\n",  # Preserve section breaks
+        secondary_chunking_regex=r"[.!?]\s+"  # Fallback to sentence boundaries
+    )
+
+def _scan_chunk(text: str) -> Dict[str, Any]:
+    """
+    Analyze a text chunk for better RAG metadata: content type, header/list/table/code
+    flags, section level and word count. Line markers come from precompiled regex scans,
+    so no Python-level loop runs over the lines
+    """
+    header = _HEADER_LINE_RE.search(text)
+    has_headers = header is not None
+    section_level = len(header.group(0)) if header else 0
+    has_lists = _LIST_LINE_RE.search(text) is not None
+    word_count = len(text.split())
+    
+    has_tables = "|" in text
+    has_code = "```" in text
+    
+    if has_code or "def " in text or "class " in text:
+        content_type = "code"
+    elif has_tables and "---" in text:
+        content_type = "table"
+    elif has_headers:
+        content_type = "header"
+    elif text[:7].lower().startswith(("figure", "diagram", "image", "chart")):
+        content_type = "figure"
+    elif has_lists:
+        content_type = "list"
+    elif word_count < 20:
+        content_type = "title_or_caption"
+    else:
+        content_type = "paragraph"
+    
+    return {
+        "content_type": content_type,
+        "word_count": word_count,
+        "has_tables": has_tables,
+        "has_headers": has_headers,
+        "has_lists": has_lists,
+        "has_code": has_code,
+        "section_level": section_level
+    }
+
+def _process_document(text_splitter, doc_idx: int, document, original_filename: str, file_path: str, file_size: int) -> List[Dict[str, Any]]:
+    """Split one parsed page into chunks with metadata"""
+    # Split document into chunks
+    nodes = text_splitter.get_nodes_from_documents([document])
+    upload_time = datetime.now().isoformat()
+    
+    chunks = []
+    for node_idx, node in enumerate(nodes):
+        chunk_id = uuid.uuid4().hex
+        
+        chunk_text = node.text.strip()
+        
+        # Create enhanced chunk metadata for better RAG
+        metadata = {
+            "filename": original_filename,
+            "file_path": file_path,
+            "source": "pdf_upload_balanced",
+            "upload_time": upload_time,
+            "file_size": file_size,
+            "document_index": doc_idx,
+            "chunk_index": node_idx,
+            "chunk_id": chunk_id,
+            "total_chunks": len(nodes),
+            "chunk_length": len(chunk_text)
+        }
+        # Analyze chunk content for better metadata
+        metadata.update(_scan_chunk(chunk_text))
+        
+        # Add any existing metadata from the document
+        if hasattr(document, 'metadata') and document.metadata:
+            metadata.update(document.metadata)
+        
+        # Add any node-specific metadata
+        if hasattr(node, 'metadata') and node.metadata:
+            metadata.update(node.metadata)
+        
+        # Only add non-empty chunks
+        if chunk_text:
+            chunks.append({
+                "text": chunk_text,
+                "metadata": metadata,
+                "chunk_id": chunk_id
+            })
+    
+    return chunks
+
+def _process_documents(text_splitter, documents, original_filename: str, file_path: str, file_size: int) -> List[Dict[str, Any]]:
+    """Chunk every parsed page of a PDF, in page order"""
+    chunks = []
+    for doc_idx, document in enumerate(documents):
+        chunks.extend(_process_document(text_splitter, doc_idx, document, original_filename, file_path, file_size))
+    return chunks
+
 class PDFParserService:
     def __init__(self):
         self.api_key = os.getenv('LLAMA_CLOUD_API_KEY')
         if not self.api_key:
             print("Warning: LLAMA_CLOUD_API_KEY not found in environment variables")
-            self.parser = None
-        else:
+        
+        # LlamaParse and llama_index are imported and built on first use, which keeps
+        # them out of startup time and memory for processes that never parse
+        self._parser = None
+        self._text_splitter = None
+    
+    @property
+    def parser(self):
+        if self._parser is None and self.api_key:
+            from llama_cloud_services import LlamaParse
+            
             # Configure LlamaParse for balanced mode (default)
-            self.parser = LlamaParse(
+            self._parser = LlamaParse(
                 api_key=self.api_key,
                 result_type="markdown",  # Markdown preserves structure better for RAG
                 # Using default balanced mode - best for documents with tables and images
@@ -36,14 +152,14 @@ class PDFParserService:
                 take_screenshot=True  # Capture page screenshots for reference
             )
         
-        # Initialize text splitter optimized for markdown content
-        self.text_splitter = SentenceSplitter(
-            chunk_size=1500,  # Larger chunks for better context in RAG
-            chunk_overlap=300,  # More overlap to preserve relationships
-            separator="\n\n",  # Split on paragraph breaks for markdown
-            paragraph_separator="\n\n\n",  # Preserve section breaks
-            secondary_chunking_regex=r"[.!?]\s+"  # Fallback to sentence boundaries
-        )
+        return self._parser
+    
+    @property
+    def text_splitter(self):
+        if self._text_splitter is None:
+            self._text_splitter = _build_text_splitter()
+        
+        return self._text_splitter
     
     async def parse_pdf(self, file_path: str, original_filename: str) -> List[Dict[str, Any]]:
         """
@@ -65,57 +181,10 @@ class PDFParserService:
             if not documents:
                 raise Exception("No markdown documents extracted from PDF")
             
-            chunks = []
-            
-            for doc_idx, document in enumerate(documents):
-                # Split document into chunks
-                nodes = self.text_splitter.get_nodes_from_documents([document])
-                
-                for node_idx, node in enumerate(nodes):
-                    chunk_id = str(uuid.uuid4())
-                    
-                    # Analyze chunk content for better metadata
-                    chunk_text = node.text.strip()
-                    content_type = self._analyze_content_type(chunk_text)
-                    
-                    # Create enhanced chunk metadata for better RAG
-                    metadata = {
-                        "filename": original_filename,
-                        "file_path": file_path,
-                        "source": "pdf_upload_balanced",
-                        "upload_time": datetime.now().isoformat(),
-                        "file_size": os.path.getsize(file_path),
-                        "document_index": doc_idx,
-                        "chunk_index": node_idx,
-                        "chunk_id": chunk_id,
-                        "total_chunks": len(nodes),
-                        "content_type": content_type,
-                        "chunk_length": len(chunk_text),
-                        "word_count": len(chunk_text.split()),
-                        "has_tables": "|" in chunk_text,
-                        "has_headers": any(line.startswith("#") for line in chunk_text.split("\n")),
-                        "has_lists": any(line.strip().startswith(("*", "-", "1.", "2.", "3.")) for line in chunk_text.split("\n")),
-                        "has_code": "```" in chunk_text,
-                        "section_level": self._get_section_level(chunk_text)
-                    }
-                    
-                    # Add any existing metadata from the document
-                    if hasattr(document, 'metadata') and document.metadata:
-                        metadata.update(document.metadata)
-                    
-                    # Add any node-specific metadata
-                    if hasattr(node, 'metadata') and node.metadata:
-                        metadata.update(node.metadata)
-                    
-                    chunk = {
-                        "text": node.text.strip(),
-                        "metadata": metadata,
-                        "chunk_id": chunk_id
-                    }
-                    
-                    # Only add non-empty chunks
-                    if chunk["text"]:
-                        chunks.append(chunk)
+            # Split and analyze pages off the event loop; chunking is cheap next to the LlamaParse
+            # call, so a worker thread is enough
+            file_size = os.path.getsize(file_path)
+            chunks = await asyncio.to_thread(_process_documents, self.text_splitter, documents, original_filename, file_path, file_size)
             
             print(f"Successfully parsed {original_filename}: {len(chunks)} chunks created")
             return chunks
@@ -124,37 +193,6 @@ class PDFParserService:
             print(f"Error parsing PDF {original_filename}: {str(e)}")
             raise Exception(f"Failed to parse PDF: {str(e)}")
     
-    def _analyze_content_type(self, text: str) -> str:
-        """
-        Analyze the content type of a text chunk for better RAG categorization
-        """
-        text_lower = text.lower()
-        
-        if "```" in text or "def " in text or "class " in text:
-            return "code"
-        elif "|" in text and "---" in text:
-            return "table"
-        elif any(line.startswith("#") for line in text.split("\n")):
-            return "header"
-        elif any(text_lower.startswith(keyword) for keyword in ["figure", "diagram", "image", "chart"]):
-            return "figure"
-        elif any(line.strip().startswith(("*", "-", "1.", "2.", "3.")) for line in text.split("\n")):
-            return "list"
-        elif len(text.split()) < 20:
-            return "title_or_caption"
-        else:
-            return "paragraph"
-    
-    def _get_section_level(self, text: str) -> int:
-        """
-        Determine the section level based on markdown headers
-        """
-        lines = text.split("\n")
-        for line in lines:
-            if line.startswith("#"):
-                return len(line) - len(line.lstrip("#"))
-        return 0
-    
     def extract_text_simple(self, file_path: str, original_filename: str) -> List[Dict[str, Any]]:
         """
         Fallback method for text extraction without LlamaParse
@@ -165,7 +203,7 @@ class PDFParserService:
             chunks = []
             
             # Create a single chunk with placeholder text
-            chunk_id = str(uuid.uuid4())
+            chunk_id = uuid.uuid4().hex
             metadata = {
                 "filename": original_filename,
                 "file_path": file_path,
@@ -192,9 +230,9 @@ class PDFParserService:
         """Get the status of the PDF parser service"""
         return {
             "service": "PDFParserService",
-            "status": "active" if self.parser else "inactive",
+            "status": "active" if self.api_key else "inactive",
             "api_key_configured": bool(self.api_key),
-            "parser_configured": bool(self.parser),
+            "parser_configured": bool(self.api_key),  # the parser is built lazily from the key
             "timestamp": datetime.now().isoformat()
         }
     
@@ -202,6 +240,8 @@ class PDFParserService:
         """Parse text content and return chunks"""
         try:
             # Create a document from the text content
+            from llama_index.core import Document
+            
             document = Document(text=content, metadata={"title": title, "source": "text_input"})
             
             # Split the text into chunks
@@ -209,7 +249,7 @@ class PDFParserService:
             
             chunks = []
             for i, node in enumerate(nodes):
-                chunk_id = str(uuid.uuid4())
+                chunk_id = uuid.uuid4().hex
                 chunk = {
                     "text": node.text.strip(),
                     "metadata": {
@@ -248,6 +288,8 @@ class PDFParserService:
                         title = getattr(result, 'title', None) or url.split('/')[-1] or "Web Page"
                         content = result.markdown or result.cleaned_html
                         
+                        from llama_index.core import Document
+                        
                         # Create a document from the crawled content
                         document = Document(
                             text=content, 
@@ -263,7 +305,7 @@ class PDFParserService:
                         
                         chunks = []
                         for i, node in enumerate(nodes):
-                            chunk_id = str(uuid.uuid4())
+                            chunk_id = uuid.uuid4().hex
                             chunk = {
                                 "text": node.text.strip(),
                                 "metadata": {
@@ -294,6 +336,7 @@ class PDFParserService:
                 import requests
                 from bs4 import BeautifulSoup
                 import re
+                from llama_index.core import Document
                 
                 headers = {
                     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
@@ -338,7 +381,7 @@ class PDFParserService:
                 
                 chunks = []
                 for i, node in enumerate(nodes):
-                    chunk_id = str(uuid.uuid4())
+                    chunk_id = uuid.uuid4().hex
                     chunk = {
                         "text": node.text.strip(),
                         "metadata": {
@@ -0,0 +1,102 @@
+import os
+import time
+import numpy as np
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# How long cached search results may be served. Uploads and deletes only invalidate the cache of the
+# process that handled them; other workers keep serving their entries until they expire, so this is
+# kept short to bound staleness under WEB_CONCURRENCY > 1
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv('SEMANTIC_CACHE_TTL_SECONDS', '60'))
+
+class _RingBuffer:
+    """Bounded embedding matrix plus results; once full, the oldest row is overwritten"""
+    
+    def __init__(self, capacity: int, dimension: int):
+        self.capacity = capacity
+        # Start small and double, so namespaces with few queries don't hold a full-size matrix
+        self.matrix = np.empty((min(capacity, 64), dimension), dtype=np.float32)
+        self.added_at = np.empty(self.matrix.shape[0], dtype=np.float64)
+        self.results: List[Any] = []
+        self.size = 0
+        self._next = 0
+    
+    def append(self, vector: np.ndarray, results: Any):
+        if self.size < self.capacity:
+            if self.size == self.matrix.shape[0]:
+                grown = np.empty((min(self.capacity, self.size * 2), self.matrix.shape[1]), dtype=np.float32)
+                grown[:self.size] = self.matrix
+                self.matrix = grown
+                self.added_at = np.resize(self.added_at, grown.shape[0])
+            self.matrix[self.size] = vector
+            self.added_at[self.size] = time.monotonic()
+            self.results.append(results)
+            self.size += 1
+            return
+        
+        self.matrix[self._next] = vector
+        self.added_at[self._next] = time.monotonic()
+        self.results[self._next] = results
+        self._next = (self._next + 1) % self.capacity
+
+class SemanticQueryCache:
+    """
+    Per-namespace cache of search results keyed by query embedding.
+    A lookup hits when a cached query's cosine similarity is at least `threshold`,
+    so paraphrased questions reuse the earlier results. With ttl_seconds set, entries older than
+    that are ignored even if the namespace was never invalidated.
+    """
+    
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1024, ttl_seconds: Optional[float] = None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        # (namespace, top_k) -> ring buffer of normalized embeddings; adding a query writes
+        # one row in place instead of copying the whole matrix
+        self._entries: Dict[Tuple[str, int], _RingBuffer] = {}
+        # Called with the namespace whenever one is invalidated (None when everything is cleared),
+        # so caches layered on top of this one can drop their entries too
+        self._listeners: List[Callable[[Optional[str]], None]] = []
+    
+    def add_listener(self, callback: Callable[[Optional[str]], None]):
+        self._listeners.append(callback)
+    
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def lookup(self, namespace: str, top_k: int, embedding) -> Optional[Any]:
+        """Return cached results for the most similar earlier query, if similar enough"""
+        entry = self._entries.get((namespace, top_k))
+        if entry is None:
+            return None
+        
+        similarities = entry.matrix[:entry.size] @ self._normalize(embedding)
+        if self.ttl is not None:
+            similarities[entry.added_at[:entry.size] < time.monotonic() - self.ttl] = -np.inf
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return entry.results[best]
+        return None
+    
+    def add(self, namespace: str, top_k: int, embedding, results: Any):
+        """Cache results for a query, dropping the oldest entries past max_entries"""
+        key = (namespace, top_k)
+        vector = self._normalize(embedding)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _RingBuffer(self.max_entries, vector.shape[0])
+        entry.append(vector, results)
+    
+    def invalidate(self, namespace: str):
+        """Forget all cached queries for a namespace (its contents changed)"""
+        for key in [key for key in self._entries if key[0] == namespace]:
+            del self._entries[key]
+        for callback in self._listeners:
+            callback(namespace)
+    
+    def clear(self):
+        self._entries.clear()
+        for callback in self._listeners:
+            callback(None)
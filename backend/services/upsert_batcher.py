@@ -0,0 +1,108 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+Vector = Dict[str, Any]
+PendingWrite = Tuple[str, List[Vector], asyncio.Future]
+
+class UpsertBatcher:
+    """
+    Coalesce concurrent Pinecone upserts into shared requests.
+    Callers await upsert(); a background task gathers writes for up to max_latency_ms, groups them
+    by namespace and sends up to max_batch_size vectors per request, so small uploads share the
+    fixed per-request cost instead of each paying it.
+    """
+    
+    def __init__(self, upsert_fn: Callable[..., Any], max_batch_size: int = 100, max_latency_ms: float = 50, max_concurrency: int = 4):
+        # upsert_fn(vectors=..., namespace=...) is blocking (Index.upsert) and is run in a worker thread
+        self.upsert_fn = upsert_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.max_concurrency = max_concurrency
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: Set[asyncio.Task] = set()
+    
+    def _ensure_worker(self):
+        """Start the batching task on first use, inside the running event loop"""
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._semaphore = self._semaphore or asyncio.Semaphore(self.max_concurrency)
+            self._worker = asyncio.create_task(self._run())
+    
+    async def upsert(self, namespace: str, vectors: List[Vector]) -> int:
+        """Upsert vectors into a namespace, returning once all of them are written"""
+        if not vectors:
+            return 0
+        
+        self._ensure_worker()
+        loop = asyncio.get_running_loop()
+        futures = []
+        
+        # Queue in request-sized slices so one large upload can't produce an oversized request
+        for i in range(0, len(vectors), self.max_batch_size):
+            future = loop.create_future()
+            self._queue.put_nowait((namespace, vectors[i:i + self.max_batch_size], future))
+            futures.append(future)
+        
+        await asyncio.gather(*futures)
+        return len(vectors)
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            deadline = loop.time() + self.max_latency
+            
+            # Collect writes until the latency window closes
+            while True:
+                if not self._queue.empty():
+                    pending.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            for namespace, writes in self._pack(pending):
+                await self._semaphore.acquire()
+                task = asyncio.create_task(self._dispatch(namespace, writes))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+    
+    def _pack(self, pending: List[PendingWrite]) -> List[Tuple[str, List[PendingWrite]]]:
+        """Group writes by namespace and pack them into requests of at most max_batch_size vectors"""
+        by_namespace: Dict[str, List[PendingWrite]] = {}
+        for write in pending:
+            by_namespace.setdefault(write[0], []).append(write)
+        
+        requests = []
+        for namespace, writes in by_namespace.items():
+            current, size = [], 0
+            for write in writes:
+                if current and size + len(write[1]) > self.max_batch_size:
+                    requests.append((namespace, current))
+                    current, size = [], 0
+                current.append(write)
+                size += len(write[1])
+            if current:
+                requests.append((namespace, current))
+        return requests
+    
+    async def _dispatch(self, namespace: str, writes: List[PendingWrite]):
+        try:
+            vectors = [vector for _, batch, _ in writes for vector in batch]
+            await asyncio.to_thread(self.upsert_fn, vectors=vectors, namespace=namespace)
+            for _, _, future in writes:
+                if not future.done():
+                    future.set_result(None)
+        except Exception as e:
+            for _, _, future in writes:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._semaphore.release()
@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Dict
+
+# Pinecone's limits: matches per query and IDs per delete request
+QUERY_TOP_K = 10000
+DELETE_BATCH_SIZE = 1000
+MAX_PASSES = 50
+
+async def delete_ids_by_filter(index, namespace: str, filter: Dict[str, Any], dimension: int) -> int:
+    """
+    Delete every vector in a namespace matching a metadata filter, returning how many were deleted.
+    Serverless indexes can't delete by metadata filter, so matching IDs are looked up (no metadata
+    or values) and deleted by ID. Any unit vector works as the query; the filter selects.
+    """
+    probe_vector = [1.0] + [0.0] * (dimension - 1)
+    deleted_ids = set()
+    
+    # Deletes are eventually consistent, so a query can return IDs already deleted in an earlier
+    # pass. Keep paging until a query comes back short of top_k, up to a fixed number of passes
+    for _ in range(MAX_PASSES):
+        results = await asyncio.to_thread(
+            index.query,
+            vector=probe_vector,
+            top_k=QUERY_TOP_K,
+            namespace=namespace,
+            filter=filter,
+            include_metadata=False,
+            include_values=False
+        )
+        matched = [match['id'] for match in results.get('matches') or []]
+        
+        ids_to_delete = [vector_id for vector_id in matched if vector_id not in deleted_ids]
+        if ids_to_delete:
+            for i in range(0, len(ids_to_delete), DELETE_BATCH_SIZE):
+                await asyncio.to_thread(index.delete, ids=ids_to_delete[i:i + DELETE_BATCH_SIZE], namespace=namespace)
+            deleted_ids.update(ids_to_delete)
+        
+        if len(matched) < QUERY_TOP_K:
+            break
+        if not ids_to_delete:
+            # A full page of already-deleted IDs: give the deletes time to land
+            await asyncio.sleep(1)
+    else:
+        print(f"Stopped deleting vectors matching {filter} after {MAX_PASSES} passes; some may remain")
+    
+    return len(deleted_ids)